@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 
-import sys
-from .bot import bot
-from . import commands
+import argparse
+from . import sharding
 
 if __name__ == "__main__":
-	if len(sys.argv) > 1 and sys.argv[1] == "--dev":
+	parser = argparse.ArgumentParser(prog="needsmorejpeg")
+	parser.add_argument("--dev", action="store_true", help="use the dev bot token (secret_dev.txt)")
+	parser.add_argument("--shards", type=int, default=None, help="total shard count (default: Discord's recommendation)")
+	parser.add_argument("--processes", type=int, default=1, help="number of processes to split the shards over")
+	args = parser.parse_args()
+	if args.dev:
 		token_file = open("secret_dev.txt", "r")
 	else:
 		token_file = open("secret_main.txt", "r")
 	token = token_file.readline().strip()
 	token_file.close()
-	bot.run(token)
-
+	sharding.run(token, shard_count=args.shards, processes=args.processes)
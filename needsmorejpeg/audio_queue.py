@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+from typing import Optional, List, Dict, Deque, Callable, Awaitable
+import collections
+import threading
+import os
+import asyncio
+import aiohttp
+import discord
+
+from .bot import bot
+
+headers = {
+	"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:76.0) Gecko/20100101 Firefox/76.0",
+}
+
+CHUNK_SIZE = 64 * 1024
+PREFETCH_LIMIT = 16 * 1024 * 1024 # bytes buffered per entry before the download waits for playback to catch up
+PREFETCH_COUNT = 2 # number of upcoming entries to start downloading while something else plays
+
+class StreamBuffer:
+	"""Buffer that is fed from the event loop and read (blocking) by the thread that pipes it into FFmpeg.
+	Reads block until data arrives, so playback can start as soon as the first chunks are in."""
+	def __init__(self):
+		self._chunks: Deque[bytes] = collections.deque()
+		self._condition = threading.Condition()
+		self._eof = False
+		self.received = 0 # total bytes fed
+		self.pending = 0 # bytes fed but not yet read
+
+	def feed(self, data: bytes) -> None:
+		with self._condition:
+			if self._eof:
+				return
+			self._chunks.append(data)
+			self.received += len(data)
+			self.pending += len(data)
+			self._condition.notify_all()
+
+	def feed_eof(self) -> None:
+		with self._condition:
+			self._eof = True
+			self._condition.notify_all()
+
+	def close(self) -> None:
+		"Drop any buffered data and unblock readers"
+		with self._condition:
+			self._chunks.clear()
+			self.pending = 0
+			self._eof = True
+			self._condition.notify_all()
+
+	def read(self, n: int = -1) -> bytes:
+		with self._condition:
+			while not self._chunks and not self._eof:
+				self._condition.wait()
+			if not self._chunks:
+				return b""
+			chunk = self._chunks.popleft()
+			if 0 <= n < len(chunk):
+				self._chunks.appendleft(chunk[n:])
+				chunk = chunk[:n]
+			self.pending -= len(chunk)
+			return chunk
+
+	def pump(self, fd: int) -> None:
+		"Copy everything fed into the pipe @param fd, then close it. Blocks, so run it on its own thread."
+		try:
+			with open(fd, "wb") as pipe:
+				while True:
+					chunk = self.read()
+					if not chunk:
+						break
+					pipe.write(chunk)
+		except OSError: # FFmpeg went away (skipped, or failed to start)
+			self.close()
+
+_session: Optional[aiohttp.ClientSession] = None
+
+def get_session() -> aiohttp.ClientSession:
+	global _session
+	if _session is None or _session.closed:
+		_session = aiohttp.ClientSession(headers=headers)
+	return _session
+
+async def _wait_for_room(buffer: StreamBuffer) -> None:
+	while buffer.pending > PREFETCH_LIMIT:
+		await asyncio.sleep(0.25)
+
+async def stream_url(url: str, buffer: StreamBuffer) -> None:
+	"Stream the body of @param url into @param buffer as it arrives"
+	async with get_session().get(url) as response:
+		if response.status != 200:
+			raise FileNotFoundError(url)
+		async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+			buffer.feed(chunk)
+			await _wait_for_room(buffer)
+
+async def stream_process(args: List[str], buffer: StreamBuffer, *, input: Optional[bytes] = None) -> None:
+	"Stream the stdout of a subprocess into @param buffer as it is produced. A failed exit raises ValueError with its stderr."
+	process = await asyncio.create_subprocess_exec(
+		*args,
+		stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+		stdout=asyncio.subprocess.PIPE,
+		stderr=asyncio.subprocess.PIPE,
+	)
+	stderr = asyncio.ensure_future(process.stderr.read()) # read alongside stdout so neither pipe can fill up and stall it
+	try:
+		if input is not None:
+			try:
+				process.stdin.write(input)
+				await process.stdin.drain()
+				process.stdin.close()
+			except (BrokenPipeError, ConnectionResetError): # it exited without reading everything; its status and stderr say why
+				pass
+		while True:
+			chunk = await process.stdout.read(CHUNK_SIZE)
+			if not chunk:
+				break
+			buffer.feed(chunk)
+			await _wait_for_room(buffer)
+	except BaseException:
+		# only kill it if we're giving up on it: killing one that has exited but not been reaped yet loses its status
+		if process.returncode is None:
+			try:
+				process.kill()
+			except ProcessLookupError:
+				pass
+		await process.stdout.read() # discard what's left, or its paused pipe never closes and wait() never returns
+		raise
+	finally:
+		await process.wait()
+		errors = (await stderr).decode(errors="replace").strip()
+	if process.returncode:
+		raise ValueError("{} exited with status {}{}".format(args[0], process.returncode, ": " + errors[:1500] if errors else ""))
+
+class QueueEntry:
+	"A single item in a guild's playback queue. The download starts on prefetch() and is streamed into FFmpeg."
+	def __init__(self, title: str, requester: discord.abc.User, opener: Callable[[StreamBuffer], Awaitable[None]]):
+		self.title = title
+		self.requester = requester
+		self.opener = opener
+		self.buffer: Optional[StreamBuffer] = None
+		self.task: Optional[asyncio.Task] = None
+		self.error: Optional[BaseException] = None
+		self.on_error: Optional[Callable[[BaseException], Awaitable[None]]] = None # e.g. to tell the requester
+
+	def prefetch(self) -> None:
+		if self.task is None:
+			self.buffer = StreamBuffer()
+			self.task = asyncio.ensure_future(self._fill())
+
+	async def _fill(self) -> None:
+		try:
+			await self.opener(self.buffer)
+		except asyncio.CancelledError:
+			raise
+		except Exception as ex:
+			self.error = ex
+			if self.on_error is not None:
+				asyncio.ensure_future(self.on_error(ex))
+		finally:
+			self.buffer.feed_eof()
+
+	def source(self) -> discord.AudioSource:
+		# FFmpeg's stdin has to be a real file descriptor, so the buffer is pumped into an OS pipe
+		self.prefetch()
+		read_fd, write_fd = os.pipe()
+		threading.Thread(target=self.buffer.pump, args=(write_fd,), daemon=True, name="needsmorejpeg-audio-pipe").start()
+		with open(read_fd, "rb") as pipe: # FFmpeg has its own copy once started
+			return discord.FFmpegOpusAudio(pipe, pipe=True)
+
+	def cancel(self) -> None:
+		if self.task is not None:
+			self.task.cancel()
+		if self.buffer is not None:
+			self.buffer.close()
+
+	def describe(self) -> str:
+		if self.buffer is None:
+			state = "waiting"
+		elif self.error is not None:
+			state = "failed"
+		elif self.task.done():
+			state = "downloaded {} KiB".format(self.buffer.received // 1024)
+		else:
+			state = "downloading ({} KiB so far)".format(self.buffer.received // 1024)
+		return "{} (requested by {}, {})".format(self.title, self.requester.display_name, state)
+
+class GuildQueue:
+	"Playback queue for a single guild. Entries are played one after another on the guild's voice client."
+	def __init__(self, guild_id: int):
+		self.guild_id = guild_id
+		self.entries: Deque[QueueEntry] = collections.deque()
+		self.current: Optional[QueueEntry] = None
+		self.voice_client: Optional[discord.VoiceClient] = None
+
+	def enqueue(self, entry: QueueEntry, voice_client: discord.VoiceClient) -> int:
+		"Add @param entry to the queue, starting playback if nothing is playing. Returns its position (0 if playing now)."
+		self.voice_client = voice_client
+		self.entries.append(entry)
+		position = len(self.entries) if self.current is not None else 0
+		self._prefetch_upcoming()
+		if self.current is None:
+			self._play_next()
+		return position
+
+	def _prefetch_upcoming(self) -> None:
+		for entry in list(self.entries)[:PREFETCH_COUNT]:
+			entry.prefetch()
+
+	def _play_next(self) -> None:
+		if self.current is not None:
+			self.current.cancel()
+		self.current = None
+		if not self.entries or self.voice_client is None or not self.voice_client.is_connected():
+			return
+		self.current = self.entries.popleft()
+		self._prefetch_upcoming()
+		try:
+			self.voice_client.play(self.current.source(), after=self._after)
+		except Exception as ex: # e.g. FFmpeg missing, or disconnected meanwhile; _after will never run, so move on here
+			print(ex, "while starting", self.current.title)
+			self._play_next()
+
+	def _after(self, error: Optional[Exception]) -> None:
+		# called from the voice client's player thread
+		bot.loop.call_soon_threadsafe(self._play_next)
+
+	def skip(self) -> bool:
+		"Stop the current entry; the next one (if any) starts automatically."
+		if self.current is None or self.voice_client is None:
+			return False
+		self.voice_client.stop()
+		return True
+
+	def clear(self) -> None:
+		for entry in self.entries:
+			entry.cancel()
+		self.entries.clear()
+		if self.voice_client is not None and self.voice_client.is_playing():
+			self.voice_client.stop()
+
+	def describe(self) -> List[str]:
+		lines = []
+		if self.current is not None:
+			lines.append("Now playing: " + self.current.describe())
+		for i, entry in enumerate(self.entries, 1):
+			lines.append("{}. {}".format(i, entry.describe()))
+		return lines
+
+queues: Dict[int, GuildQueue] = {}
+
+def get_queue(guild: discord.Guild) -> GuildQueue:
+	if guild.id not in queues:
+		queues[guild.id] = GuildQueue(guild.id)
+	return queues[guild.id]
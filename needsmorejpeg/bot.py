@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-from typing import Optional, List, Tuple, Callable, Dict, Union
+from typing import Optional, List, Tuple, Callable, Dict, Union, Iterable, FrozenSet
 import discord
 from bs4 import BeautifulSoup as BS
 from discord.ext import commands
@@ -8,18 +8,23 @@ import PIL.ImageOps
 import PIL.ImageFilter
 import PIL.ImageEnhance
 import io
+import collections
 import asyncio
 import urllib.request
 import random
 import subprocess
 
-bot = commands.Bot(command_prefix=">", activity=discord.Game("use >jpeg"))
+from . import metrics
+from .outbound import outbound
+
+bot = commands.AutoShardedBot(command_prefix=">", activity=discord.Game("use >jpeg"))
 
 def is_owner(ctx) -> bool:
 	return bot.is_owner(ctx.message.author)
 
 class ErrorWithMessage(Exception):
 	def __init__(self, msg):
+		super().__init__(msg) # so it survives pickling back from a worker process
 		self.msg = msg
 
 @bot.event
@@ -27,27 +32,51 @@ async def on_command_error(ctx, error):
 	if isinstance(error, discord.ext.commands.CommandNotFound):
 		return
 	elif isinstance(error.__cause__, discord.errors.Forbidden):
-		await ctx.message.add_reaction("⛔")
+		outbound.add_reaction(ctx.message, "⛔")
 	elif isinstance(error.__cause__, PIL.Image.DecompressionBombError):
-		await ctx.message.add_reaction("😵")
+		outbound.add_reaction(ctx.message, "😵")
 	elif isinstance(error.__cause__, ErrorWithMessage):
-		await ctx.message.add_reaction("⚠")
+		outbound.add_reaction(ctx.message, "⚠")
 		await ctx.send(error.__cause__.msg)
 	else:
-		await ctx.message.add_reaction("⚠")
+		outbound.add_reaction(ctx.message, "⚠")
 		raise error
 		
+# message id -> ids of users allowed to delete it by reacting ❌, for messages this bot posted.
+# Lets on_raw_reaction_add authorize deletions without fetching the message.
+deletable_messages: "collections.OrderedDict[int, FrozenSet[int]]" = collections.OrderedDict()
+deletable_messages_limit = 10000
+
+def remember_deletable(message: discord.Message, deleter_ids: Iterable[int]) -> None:
+	deletable_messages[message.id] = frozenset(deleter_ids)
+	deletable_messages.move_to_end(message.id)
+	while len(deletable_messages) > deletable_messages_limit:
+		deletable_messages.popitem(last=False)
+
 @bot.event
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
 	if payload.user_id == bot.user.id: # ignore our own reactions
 		return
 	if payload.emoji.name == "❌": # deletion request
-		message = await bot.get_channel(payload.channel_id).fetch_message(payload.message_id)
-		if message.author != bot.user:
+		if payload.member is not None and payload.member.bot:
 			return
-		if (not payload.member.bot) and payload.member in message.mentions:
+		channel = bot.get_channel(payload.channel_id)
+		deleter_ids = deletable_messages.get(payload.message_id)
+		if deleter_ids is None: # not posted since startup (or evicted); ask Discord
+			message = await channel.fetch_message(payload.message_id)
+			if message.author != bot.user:
+				return
+			deleter_ids = frozenset(member.id for member in message.mentions)
+		else:
+			message = channel.get_partial_message(payload.message_id)
+		if payload.user_id in deleter_ids:
+			deletable_messages.pop(payload.message_id, None)
 			await message.delete()
-			await message.channel.send("Deleted", delete_after=5)
+			await channel.send("Deleted", delete_after=5)
+
+@bot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+	deletable_messages.pop(payload.message_id, None)
 """
 @bot.event
 async def on_reaction_add(reaction: discord.Reaction, user: Union[discord.Member, discord.User]):
@@ -67,6 +96,12 @@ async def quit(ctx):
 	await ctx.message.add_reaction("👋")
 	await ctx.bot.logout()
 
+@bot.command(hidden=True)
+@commands.check(is_owner)
+async def stats(ctx):
+	"Shows latency timings and counters"
+	await ctx.send('\n'.join(metrics.summary()) or "No metrics yet")
+
 @bot.command()
 async def whoami(ctx):
 	"Shows your nick, global name, and user id.\nFor when you're having an existential crisis."
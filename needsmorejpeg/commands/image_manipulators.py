@@ -15,69 +15,95 @@ import math # sin/cos
 import numpy as np
 
 from ..bot import bot, ErrorWithMessage
-from ..image_manipulator import image_manipulator, limit_size
+from .. import convolution
+from ..image_manipulator import image_manipulator, limit_size, promote, MAX_PIXELS, COMPACT_MODES, FILTERABLE_MODES, ALPHA_MODES
 
-@image_manipulator(names=["jpg", "jpeg"], argtypes=())
+@image_manipulator(names=["jpg", "jpeg"], argtypes=(), modes=COMPACT_MODES, cost=2)
 def jpeg(image: PIL.Image.Image) -> PIL.Image.Image:
 	"JPEG Compress an image with lowest quality"
 	outfile = io.BytesIO()
-	image.convert("RGB").save(outfile, format="JPEG", quality=1)
+	image.convert("L" if image.mode in ("L", "LA") else "RGB").save(outfile, format="JPEG", quality=1)
 	outfile.seek(0)
 	return PIL.Image.open(outfile)
 
-@image_manipulator(argtypes=())
+@image_manipulator(argtypes=(), modes=COMPACT_MODES)
 def rotate180(image: PIL.Image.Image) -> PIL.Image.Image:
 	"Rotate an image 180 degrees (DEPRECATED)"
 	return image.rotate(180)
 
-@image_manipulator(argtypes=(float,))
+@image_manipulator(argtypes=(float,), modes=ALPHA_MODES, cost=2)
 def rotate(image: PIL.Image.Image, degrees: float) -> PIL.Image.Image:
 	"Rotate an image a number of degrees."
 	return image.rotate(degrees, expand=True)
 
-@image_manipulator(argtypes=(float,))
+@image_manipulator(argtypes=(float,), modes=FILTERABLE_MODES, cost=3)
 def sharpen(image: PIL.Image.Image, factor: float) -> PIL.Image.Image:
 	"Sharpen an image by a factor."
 	sharpener = PIL.ImageEnhance.Sharpness(image)
 	return sharpener.enhance(factor)
 
-@image_manipulator(argtypes=(float,))
+@image_manipulator(argtypes=(float,), modes=COMPACT_MODES)
 def zoom(image: PIL.Image.Image, zoom_factor: float) -> PIL.Image.Image:
 	"Zoom in to an image (centered at the center).\nArgument is a percentage greater than or equal to 100 (without the %), or a scale factor less than 100."
 	if zoom_factor <= 0:
 		raise ErrorWithMessage("Cannot have a negative zoom factor")
 	if zoom_factor >= 100:
 		zoom_factor /= 100
+	if zoom_factor < 1:
+		image = promote(image, ALPHA_MODES) # zooming out exposes area outside the image, which should be transparent
 	width, height = image.size
 	
 	new_width, new_height = width / zoom_factor, height / zoom_factor
 	
 	return image.crop(((width - new_width)/2, (height - new_height)/2, (width + new_width)/2, (height + new_height)/2))
 
-@image_manipulator(argtypes=())
+@image_manipulator(argtypes=(), modes=COMPACT_MODES)
 def invert(image: PIL.Image.Image) -> PIL.Image.Image:
 	"Invert the colors of an image"
+	if image.mode == "P": # only the palette needs inverting
+		new_image = image.copy()
+		new_image.putpalette([255 - value for value in image.getpalette()])
+		return new_image
+	if image.mode in ("L", "RGB"):
+		return PIL.ImageOps.invert(image)
 	# return PIL.ImageOps.invert(image) # doesn't work with alpha channel
 	# https://stackoverflow.com/a/11491499/5142683
 	arr = np.array(image)
-	arr[:,:,0:3] = 255 - arr[:,:,0:3]
+	arr[:,:,:-1] = 255 - arr[:,:,:-1]
 	return PIL.Image.fromarray(arr)
 
-@image_manipulator(argtypes=())
+@image_manipulator(argtypes=(), modes=COMPACT_MODES)
 def hflip(image: PIL.Image.Image) -> PIL.Image.Image:
 	"Flip an image horizontally"
 	return PIL.ImageOps.flip(image.rotate(90, expand=True)).rotate(-90, expand=True)
 
-@image_manipulator(argtypes=())
+@image_manipulator(argtypes=(), modes=COMPACT_MODES)
 def vflip(image: PIL.Image.Image) -> PIL.Image.Image:
 	"Flip an image vertically"
-	return PIL.ImageOps.flip(image)
+	return PIL.ImageOps.flip(image) # a plain row transpose, so palette and greyscale images stay as they are
 
-@image_manipulator(argtypes=())
+@image_manipulator(argtypes=(), modes=FILTERABLE_MODES, variance=lambda: convolution.BLUR_FILTER_VARIANCE, cost=2)
 def blur(image: PIL.Image.Image) -> PIL.Image.Image:
 	"Blur an image"
 	return image.filter(PIL.ImageFilter.BLUR)
 
+@image_manipulator(argtypes=(float,), names=("gblur", "gaussblur"), modes=FILTERABLE_MODES, variance=lambda radius: min(max(radius, 0), MAX_PIXELS) ** 2, cost=4)
+def gblur(image: PIL.Image.Image, radius: float) -> PIL.Image.Image:
+	"Gaussian blur an image. Radius is the standard deviation in pixels; any size is fine."
+	if radius > max(image.size):
+		radius = max(image.size) # everything is one smear past this anyway
+	return convolution.gaussian_blur(image, radius)
+
+@image_manipulator(argtypes=(int,), modes=FILTERABLE_MODES, variance=lambda radius: convolution.box_variance(min(max(radius, 0), MAX_PIXELS)), cost=4)
+def boxblur(image: PIL.Image.Image, radius: int) -> PIL.Image.Image:
+	"Box blur an image, averaging each pixel with its neighbors up to radius pixels away."
+	return convolution.box_blur(image, min(max(radius, 0), max(image.size)))
+
+@image_manipulator(argtypes=(float, float), modes=FILTERABLE_MODES, cost=5)
+def unsharp(image: PIL.Image.Image, radius: float, amount: float) -> PIL.Image.Image:
+	"Sharpen an image with an unsharp mask of a given radius (in pixels) and amount (1 is a moderate sharpen)."
+	return convolution.unsharp_mask(image, min(max(radius, 0), max(image.size)), amount)
+
 color_names = {
 	"red": "FF0000",
 	"orange": "FF8000",
@@ -97,9 +123,16 @@ color_names = {
 
 hue_range = 32.0
 
+MAX_HIGHLIGHT_COLORS = 16
+
+def hues(colors: "Sequence[Sequence[int, int, int, ...]]") -> np.ndarray:
+	"Hues of several colors in range [0,255], using one HSV conversion for all of them"
+	strip = PIL.Image.frombytes("RGB", (len(colors), 1), bytes(c for rgb in colors for c in rgb[:3]))
+	return np.array(strip.convert("HSV"))[0,:,0]
+
 def hue(rgb: "Sequence[int, int, int, ...]") -> int:
 	"Hue of a color in range [0,255]"
-	return  PIL.Image.new("RGB", (1,1), rgb[:3]).convert("HSV").getpixel((0,0))[0]
+	return int(hues([rgb])[0])
 
 def parse_color(color_: str) -> Tuple[int, int, int]:
 	color = color_
@@ -116,7 +149,26 @@ def parse_color(color_: str) -> Tuple[int, int, int]:
 		raise ErrorWithMessage("Unrecognized color: %s" % color_)
 	return tuple(int(color[i:i+2], 16) for i in (0,2,4))
 
-@image_manipulator(argtypes=())
+color_hues: Dict[str, int] = dict(zip(color_names, map(int, hues([parse_color(name) for name in color_names]))))
+
+def parse_hue(color: str) -> int:
+	"Hue in range [0,255] of a color name or hex code"
+	if color in color_hues:
+		return color_hues[color]
+	return hue(parse_color(color))
+
+def parse_hues(colors: str) -> np.ndarray:
+	"Hues in range [0,255] of comma-separated color names or hex codes"
+	colors = [color for color in colors.split(",") if color]
+	if not colors:
+		raise ErrorWithMessage("No colors given")
+	if len(colors) > MAX_HIGHLIGHT_COLORS:
+		raise ErrorWithMessage("Too many colors ({}); the most I'll highlight at once is {}".format(len(colors), MAX_HIGHLIGHT_COLORS))
+	unnamed = [parse_color(color) for color in colors if color not in color_hues]
+	unnamed_hues = iter(hues(unnamed) if unnamed else [])
+	return np.array([color_hues[color] if color in color_hues else next(unnamed_hues) for color in colors], dtype=np.int16)
+
+@image_manipulator(argtypes=(), cost=4)
 def saturate(image: PIL.Image.Image) -> PIL.Image.Image:
 	"Saturate all colors in an image."
 	arr = np.array(image.convert("HSV"))
@@ -126,7 +178,7 @@ def saturate(image: PIL.Image.Image) -> PIL.Image.Image:
 		new_image.putalpha(image.getchannel('A'))
 	return new_image
 
-@image_manipulator(argtypes=())
+@image_manipulator(argtypes=(), cost=4)
 def desaturate(image: PIL.Image.Image) -> PIL.Image.Image:
 	"Desaturate all colors in an image by half"
 	arr = np.array(image.convert("HSV"))
@@ -136,22 +188,26 @@ def desaturate(image: PIL.Image.Image) -> PIL.Image.Image:
 		new_image.putalpha(image.getchannel('A'))
 	return new_image
 
-@image_manipulator(argtypes=(), names=("grey", "gray", "greyscale", "grayscale"))
+@image_manipulator(argtypes=(), names=("grey", "gray", "greyscale", "grayscale"), modes=COMPACT_MODES, cost=2)
 def grey(image: PIL.Image.Image) -> PIL.Image.Image:
 	"Desaturate all colors in an image completely"
-	arr = np.array(image.convert("HSV"))
-	arr[:,:,1] = 0
-	new_image = PIL.Image.fromarray(arr, mode="HSV").convert("RGB")
+	# zero saturation leaves HSV value, i.e. the largest of r, g and b
+	if image.mode in ("L", "LA"):
+		return image
+	if image.mode == "P":
+		palette = image.getpalette()
+		new_image = image.copy()
+		new_image.putpalette([max(palette[i:i+3]) for i in range(0, len(palette), 3) for _ in range(3)])
+		return new_image
+	new_image = PIL.Image.fromarray(np.array(image)[:,:,0:3].max(axis=2))
 	if 'A' in image.mode:
-		new_image.putalpha(image.getchannel('A'))
+		new_image = PIL.Image.merge("LA", (new_image, image.getchannel('A')))
 	return new_image
 
-@image_manipulator(argtypes=(str,))
+@image_manipulator(argtypes=(str,), cost=4)
 def highlight(image: PIL.Image.Image, color: str) -> PIL.Image.Image:
 	"Highlight a particular color in an image"
-	color = parse_color(color)
-
-	h = hue(color)
+	h = parse_hue(color)
 
 	h_low = (h - hue_range) % 255
 	h_high = (h + hue_range) % 255
@@ -167,12 +223,10 @@ def highlight(image: PIL.Image.Image, color: str) -> PIL.Image.Image:
 		new_image.putalpha(image.getchannel('A'))
 	return new_image
 
-@image_manipulator(argtypes=(str,), names=("highlight_fade", "highlight_beta"))
+@image_manipulator(argtypes=(str,), names=("highlight_fade", "highlight_beta"), cost=4)
 def highlight_beta(image: PIL.Image.Image, color: str) -> PIL.Image.Image:
 	"Highlight a particular color in an image"
-	color = parse_color(color)
-
-	h = hue(color)
+	h = parse_hue(color)
 
 	arr = np.array(image.convert("HSV"))
 
@@ -185,12 +239,39 @@ def highlight_beta(image: PIL.Image.Image, color: str) -> PIL.Image.Image:
 		new_image.putalpha(image.getchannel('A'))
 	return new_image
 
-@image_manipulator(argtypes=(str,))
+def highlight_table(targets: np.ndarray, falloff: float) -> np.ndarray:
+	"New saturation for every (hue, saturation) pair, flattened to 256*hue + saturation, when highlighting hues @param targets"
+	# circular hue distance from each of the 256 hues to its nearest target
+	differences = np.abs(np.arange(256, dtype=np.int16)[:,None] - targets)
+	distances = np.minimum(differences, 256 - differences).min(axis=1)
+	if falloff <= 0:
+		weights = (distances <= hue_range).astype(np.float64)
+	else:
+		weights = np.clip(1 - (distances - hue_range) / falloff, 0, 1)
+		weights = weights * weights * (3 - 2 * weights) # smoothstep, so the fade has no visible edges
+	return (np.arange(256)[None,:] * weights[:,None]).astype(np.uint8).ravel()
+
+@image_manipulator(argtypes=(str, float), names=("highlights", "highlight_multi"), cost=5)
+def highlights(image: PIL.Image.Image, colors: str, falloff: float) -> PIL.Image.Image:
+	"Highlight several colors in an image at once.\nColors are comma-separated names or hex codes (e.g. red,blue,#00FF80). Falloff (in hue steps, 0-127) is how far past each color's range the highlight fades out; 0 gives a hard edge like highlight."
+	table = highlight_table(parse_hues(colors), falloff)
+
+	arr = np.array(image.convert("HSV"))
+
+	# hue and saturation are bytes, so one lookup per pixel does it, whatever the number of colors
+	index = arr[:,:,0].astype(np.uint16)
+	index <<= 8
+	index |= arr[:,:,1]
+	arr[:,:,1] = table[index]
+	new_image = PIL.Image.fromarray(arr, mode="HSV").convert("RGB")
+	if 'A' in image.mode:
+		new_image.putalpha(image.getchannel('A'))
+	return new_image
+
+@image_manipulator(argtypes=(str,), cost=4)
 def tint(image: PIL.Image.Image, color: str) -> PIL.Image.Image:
 	"Tint an image to a particular color"
-	color = parse_color(color)
-
-	h = hue(color)
+	h = parse_hue(color)
 
 	arr = np.array(image.convert("HSV"))
 	arr[:,:,0] = int(h)
@@ -199,7 +280,7 @@ def tint(image: PIL.Image.Image, color: str) -> PIL.Image.Image:
 		new_image.putalpha(image.getchannel('A'))
 	return new_image
 
-@image_manipulator(argtypes=(int,))
+@image_manipulator(argtypes=(int,), cost=4)
 def hueshift(image: PIL.Image.Image, amount: int) -> PIL.Image.Image:
 	"Hue shift an image. Hues range from [0, 255]."
 
@@ -210,7 +291,7 @@ def hueshift(image: PIL.Image.Image, amount: int) -> PIL.Image.Image:
 		new_image.putalpha(image.getchannel('A'))
 	return new_image
 
-@image_manipulator(names=["crush", "crunch"], argtypes=(float,))
+@image_manipulator(names=["crush", "crunch"], argtypes=(float,), modes=ALPHA_MODES, cost=8)
 def crunch(image: PIL.Image.Image, degrees: float) -> PIL.Image.Image:
 	"Rotate an image a number of degrees, jpeg it, rotate it again in the opposite direction, jpeg it, then zoom in to the original size."
 	degrees %= 360
@@ -1,14 +1,25 @@
 #!/usr/bin/env python3
 from typing import Optional
-import subprocess
 import discord # import FFmpegAudio
-import urllib
-import io
-import os
-import tempfile
-import asyncio
+import functools
+import shutil
 
 from ..bot import bot, commands, is_owner
+from ..audio_queue import QueueEntry, get_queue, stream_url, stream_process
+from ..voice_sessions import voice_sessions
+from ..outbound import outbound
+
+async def report_failure(ctx, entry: QueueEntry, error: BaseException) -> None:
+	await ctx.send("Could not play {}: {}".format(entry.title, error))
+	outbound.add_reaction(ctx.message, "🔇")
+
+async def enqueue(ctx, voice_channel: discord.VoiceChannel, entry: QueueEntry) -> None:
+	entry.on_error = functools.partial(report_failure, ctx, entry)
+	voice_client = await voice_sessions.connect(voice_channel)
+	position = get_queue(ctx.message.guild).enqueue(entry, voice_client)
+	if position:
+		await ctx.send("Queued at position {}: {}".format(position, entry.title), delete_after=10)
+	await ctx.message.add_reaction("✅")
 
 @bot.command()
 async def say(ctx, *, args: str, espeak_args = []):
@@ -20,33 +31,12 @@ async def say(ctx, *, args: str, espeak_args = []):
 		await ctx.send("Could not find a voice channel")
 		raise ValueError
 
-	stderr = tempfile.TemporaryFile()
-
-	try:
-		espeak = subprocess.Popen(["espeak", "--stdout", *espeak_args], stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=stderr)
-	except FileNotFoundError:
+	if shutil.which("espeak") is None:
 		await ctx.send("Could not open espeak to generate voice")
 		raise ValueError
 
-	espeak.stdin.write(args.encode())
-	espeak.stdin.close()
-
-	# voice_data_wave = espeak.stdout.read()
-	voice_data = discord.FFmpegOpusAudio(espeak.stdout, pipe=True)
-
-	if (espeak.poll() is not None and espeak.poll()):
-		stderr.seek(0)
-		await ctx.send("Error: %s" % stderr.read().decode())
-		await ctx.message.add_reaction("🔇")
-		return
-
-	if ctx.message.guild.voice_client is not None and ctx.message.guild.voice_client.is_connected():
-		voice_client = ctx.message.guild.voice_client
-	else:
-		voice_client = await voice_channel.connect()
-
-	voice_client.play(voice_data)
-	await ctx.message.add_reaction("✅")
+	opener = functools.partial(stream_process, ["espeak", "--stdout", *espeak_args], input=args.encode())
+	await enqueue(ctx, voice_channel, QueueEntry("say: " + args[:50], ctx.author, opener))
 
 @bot.command()
 async def say_slow(ctx, *, args: str):
@@ -74,18 +64,17 @@ async def leave(ctx):
 		await ctx.send("Could not find a voice channel")
 		raise ValueError
 
-	if ctx.message.guild.voice_client is not None and ctx.message.guild.voice_client.is_connected():
-		voice_client = ctx.message.guild.voice_client
-	else:
+	if not await voice_sessions.disconnect(ctx.message.guild):
 		await ctx.send("Could not find a voice channel")
 		raise ValueError
 
-	await voice_client.disconnect()
 	await ctx.message.add_reaction("✅")
 
-headers = {
-	"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv76.0) Gecko/20100101 Firefox 76.0",
-}
+@bot.command(hidden=True)
+@commands.check(is_owner)
+async def voicestats(ctx):
+	"Shows voice session counts"
+	await ctx.send(', '.join("{}: {}".format(key, value) for key, value in voice_sessions.stats().items()))
 
 @bot.command()
 #@commands.check(is_owner)
@@ -98,31 +87,16 @@ async def play(ctx, arg: Optional[str]):
 		await ctx.send("Could not find a voice channel")
 		raise ValueError
 
-	await ctx.message.add_reaction("🔜")
-
 	if ctx.message.attachments:
-		data = await ctx.message.attachments[0].read()
-	else:
-		request = urllib.request.Request(arg, None, headers=headers)
-		response = urllib.request.urlopen(request)
-		if not response:
-			raise ValueError
-		data = response.read()
-
-	file = tempfile.TemporaryFile()
-	file.write(data)
-	file.seek(0)
-
-	# voice_data_wave = espeak.stdout.read()
-	voice_data = discord.FFmpegOpusAudio(file, pipe=True)
-
-	if ctx.message.guild.voice_client is not None and ctx.message.guild.voice_client.is_connected():
-		voice_client = ctx.message.guild.voice_client
+		url = ctx.message.attachments[0].url
+		title = ctx.message.attachments[0].filename
+	elif arg is not None and arg.startswith('http'):
+		url = title = arg
 	else:
-		voice_client = await voice_channel.connect()
+		await ctx.send("Invalid URL")
+		raise ValueError
 
-	voice_client.play(voice_data)
-	await ctx.message.add_reaction("✅")
+	await enqueue(ctx, voice_channel, QueueEntry(title, ctx.author, functools.partial(stream_url, url)))
 
 @bot.command()
 async def yt(ctx, arg: str):
@@ -136,29 +110,27 @@ async def yt(ctx, arg: str):
 
 	if arg.startswith('-') or not (arg.startswith('http') or arg.startswith('ytsearch:')):
 		await ctx.send("Invalid URL")
-		raise ValueEroor
-
-	fd, filename = tempfile.mkstemp(suffix=".mp3")
-
-	await ctx.message.add_reaction("🔜")
-
-	ytdl = subprocess.Popen(["youtube-dl", arg, "--no-playlist", "--no-continue", "-f", "bestaudio", "--extract-audio", "--audio-format", "mp3", "-o", filename])
-	while ytdl.poll() is None:
-		await asyncio.sleep(1)
-
-	# voice_data_wave = espeak.stdout.read()
-	voice_data = discord.FFmpegOpusAudio(filename, pipe=False)
-
-	if ctx.message.guild.voice_client is not None and ctx.message.guild.voice_client.is_connected():
-		voice_client = ctx.message.guild.voice_client
-	else:
-		voice_client = await voice_channel.connect()
-
-	#os.remove(filename) # I don't know if ffmpeg is guaranteed to have opened the file yet, so remove it in a callback
-	voice_client.play(voice_data, after = lambda err: os.remove(filename))
+		raise ValueError
 
-	await ctx.message.add_reaction("✅")
+	# stream the best audio format to stdout instead of extracting an mp3 to disk first; FFmpeg decodes it as it arrives
+	opener = functools.partial(stream_process, ["youtube-dl", arg, "--no-playlist", "--quiet", "-f", "bestaudio", "-o", "-"])
+	await enqueue(ctx, voice_channel, QueueEntry(arg, ctx.author, opener))
 
 @bot.command()
 async def ytsearch(ctx, *, arg: str):
 	return await yt(ctx, "ytsearch: {}".format(arg))
+
+@bot.command(name="queue")
+async def queue_(ctx):
+	"Shows what is playing and what is queued in this server"
+	lines = get_queue(ctx.message.guild).describe()
+	await ctx.send('\n'.join(lines) if lines else "Nothing is queued")
+
+@bot.command()
+async def skip(ctx):
+	"Skips what is currently playing"
+	if get_queue(ctx.message.guild).skip():
+		await ctx.message.add_reaction("✅")
+	else:
+		await ctx.message.add_reaction("⚠")
+		await ctx.send("Nothing is playing", delete_after=5)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Separable blur kernels on numpy arrays. Small Gaussians are convolved exactly; large ones are
+# approximated by three box blurs, each computed from a running sum so the cost per pixel doesn't
+# depend on the radius.
+from typing import List
+import math
+import numpy as np
+import PIL.Image
+
+BOX_SIGMA_THRESHOLD = 3.0 # above this, approximate Gaussians with box blurs
+BLUR_FILTER_VARIANCE = 2.75 # per-axis variance of PIL.ImageFilter.BLUR's 5x5 ring kernel
+
+def box_variance(radius: int) -> float:
+	"Per-axis variance of a box blur of width 2*@param radius+1"
+	return ((2 * radius + 1) ** 2 - 1) / 12
+
+def gaussian_kernel(sigma: float) -> np.ndarray:
+	radius = max(1, math.ceil(3 * sigma))
+	x = np.arange(-radius, radius + 1, dtype=np.float32)
+	kernel = np.exp(-x * x / (2 * sigma * sigma))
+	return kernel / kernel.sum()
+
+def box_radii_for_gaussian(sigma: float, passes: int = 3) -> List[int]:
+	"Radii of @param passes box blurs whose combined variance is as close as possible to sigma**2"
+	# http://blog.ivank.net/fastest-gaussian-blur.html
+	ideal_width = math.sqrt(12 * sigma * sigma / passes + 1)
+	lower = int(ideal_width)
+	if lower % 2 == 0:
+		lower -= 1
+	upper = lower + 2
+	ideal_lower_count = (12 * sigma * sigma - passes * lower * lower - 4 * passes * lower - 3 * passes) / (-4 * lower - 4)
+	lower_count = round(ideal_lower_count)
+	return [(lower if i < lower_count else upper) // 2 for i in range(passes)]
+
+def convolve_axis(arr: np.ndarray, kernel: np.ndarray, axis: int) -> np.ndarray:
+	"Convolve @param arr with the symmetric 1-D @param kernel along @param axis, extending edges"
+	radius = len(kernel) // 2
+	pad = [(0, 0)] * arr.ndim
+	pad[axis] = (radius, radius)
+	padded = np.pad(arr, pad, mode="edge")
+	length = arr.shape[axis]
+	out = np.zeros_like(arr)
+	for i, weight in enumerate(kernel):
+		out += weight * np.take(padded, range(i, i + length), axis=axis)
+	return out
+
+def box_blur_axis(arr: np.ndarray, radius: int, axis: int) -> np.ndarray:
+	"Box blur of width 2*@param radius+1 along @param axis in O(1) per pixel, extending edges"
+	if radius <= 0:
+		return arr
+	pad = [(0, 0)] * arr.ndim
+	pad[axis] = (radius + 1, radius)
+	sums = np.cumsum(np.pad(arr, pad, mode="edge"), axis=axis, dtype=np.float64)
+	length = arr.shape[axis]
+	width = 2 * radius + 1
+	upper = np.take(sums, range(width, width + length), axis=axis)
+	lower = np.take(sums, range(0, length), axis=axis)
+	return ((upper - lower) / width).astype(arr.dtype)
+
+def gaussian_blur_array(arr: np.ndarray, sigma: float) -> np.ndarray:
+	"Gaussian blur of a float HxW or HxWxC array"
+	if sigma <= 0:
+		return arr
+	if sigma <= BOX_SIGMA_THRESHOLD:
+		kernel = gaussian_kernel(sigma)
+		return convolve_axis(convolve_axis(arr, kernel, 0), kernel, 1)
+	for radius in box_radii_for_gaussian(sigma):
+		arr = box_blur_axis(box_blur_axis(arr, radius, 0), radius, 1)
+	return arr
+
+def _apply(image: PIL.Image.Image, blur) -> PIL.Image.Image:
+	arr = blur(np.asarray(image, dtype=np.float32))
+	return PIL.Image.fromarray(np.clip(np.rint(arr), 0, 255).astype(np.uint8))
+
+def gaussian_blur(image: PIL.Image.Image, sigma: float) -> PIL.Image.Image:
+	"Gaussian blur of an L, LA, RGB or RGBA image with standard deviation @param sigma pixels"
+	return _apply(image, lambda arr: gaussian_blur_array(arr, sigma))
+
+def box_blur(image: PIL.Image.Image, radius: int) -> PIL.Image.Image:
+	"Box blur of an L, LA, RGB or RGBA image over a (2*@param radius+1)-pixel square"
+	return _apply(image, lambda arr: box_blur_axis(box_blur_axis(arr, radius, 0), radius, 1))
+
+def unsharp_mask(image: PIL.Image.Image, sigma: float, amount: float) -> PIL.Image.Image:
+	"Sharpen by adding back @param amount times the detail a Gaussian blur of @param sigma removes"
+	def sharpen(arr: np.ndarray) -> np.ndarray:
+		blurred = gaussian_blur_array(arr, sigma)
+		if arr.ndim == 3 and arr.shape[2] in (2, 4): # leave alpha alone
+			blurred[:,:,-1] = arr[:,:,-1]
+		return arr + amount * (arr - blurred)
+	return _apply(image, sharpen)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Watches this process's RSS and the machine's available memory. When either crosses its threshold,
+# the governor lowers job concurrency, asks everything registered with it to shed memory (idle
+# workers, caches), and returns freed heap to the OS; when the pressure is gone, concurrency is restored.
+from typing import Optional, Dict, Callable, Union
+import asyncio
+import ctypes
+import ctypes.util
+import gc
+
+from . import metrics
+
+def _status_bytes(pid: Union[int, str], field: str) -> Optional[int]:
+	try:
+		with open("/proc/{}/status".format(pid)) as f:
+			for line in f:
+				if line.startswith(field + ":"):
+					return int(line.split()[1]) * 1024
+	except (OSError, ValueError):
+		pass
+	return None
+
+def process_rss(pid: Union[int, str] = "self") -> Optional[int]:
+	"Resident set size of process @param pid in bytes (Linux only; None elsewhere)"
+	return _status_bytes(pid, "VmRSS")
+
+def peak_rss(pid: Union[int, str] = "self") -> Optional[int]:
+	"Highest resident set size of process @param pid since it started or reset_peak_rss(), in bytes (Linux only; None elsewhere)"
+	return _status_bytes(pid, "VmHWM")
+
+def reset_peak_rss() -> bool:
+	"Restart this process's peak_rss() from its current RSS. Returns False where that isn't possible."
+	try:
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+		return True
+	except OSError:
+		return False
+
+def available_memory() -> Optional[int]:
+	"Memory available to new allocations without swapping, in bytes (Linux only; None elsewhere)"
+	try:
+		with open("/proc/meminfo") as f:
+			for line in f:
+				if line.startswith("MemAvailable:"):
+					return int(line.split()[1]) * 1024
+	except (OSError, ValueError):
+		pass
+	return None
+
+def _trim_heap() -> None:
+	"Hand freed-but-fragmented heap memory (PIL and numpy buffers are big malloc users) back to the OS"
+	try:
+		ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim(0)
+	except (OSError, AttributeError, TypeError): # not glibc
+		pass
+
+class ResourceGovernor:
+	def __init__(self, *, rss_limit: int = 1536 * 2**20, min_available: int = 512 * 2**20, interval: float = 15.0, pressure_concurrency: float = 0.5):
+		self.rss_limit = rss_limit
+		self.min_available = min_available
+		self.interval = interval
+		self.pressure_concurrency = pressure_concurrency
+		self.concurrency_factor = 1.0 # multiplied into job concurrency limits
+		self.under_pressure = False
+		self.rss: Optional[int] = None
+		self.available: Optional[int] = None
+		self.shrinkers: Dict[str, Callable[[], None]] = {}
+		self._watcher: Optional[asyncio.Task] = None
+
+	def register(self, name: str, shrink: Callable[[], None]) -> None:
+		"Have @param shrink called to free memory whenever the governor sees memory pressure"
+		self.shrinkers[name] = shrink
+
+	def check(self) -> bool:
+		self.rss = process_rss()
+		self.available = available_memory()
+		pressure = (self.rss is not None and self.rss > self.rss_limit) or (self.available is not None and self.available < self.min_available)
+		if pressure:
+			metrics.count("memory_pressure_checks")
+			if not self.under_pressure:
+				metrics.count("memory_pressure_events")
+			self.concurrency_factor = self.pressure_concurrency
+			for shrink in self.shrinkers.values():
+				shrink()
+			gc.collect()
+			_trim_heap()
+		else:
+			self.concurrency_factor = 1.0
+		self.under_pressure = pressure
+		return pressure
+
+	def start(self) -> None:
+		if self._watcher is None or self._watcher.done():
+			self._watcher = asyncio.ensure_future(self._watch())
+
+	async def _watch(self) -> None:
+		while True:
+			self.check()
+			await asyncio.sleep(self.interval)
+
+	def describe(self) -> str:
+		def mib(n: Optional[int]) -> str:
+			return "?" if n is None else "{:.0f} MiB".format(n / 2**20)
+		return "rss {} (limit {}), available {} (min {}), {}".format(
+			mib(self.rss), mib(self.rss_limit), mib(self.available), mib(self.min_available),
+			"UNDER PRESSURE, concurrency x{}".format(self.concurrency_factor) if self.under_pressure else "ok")
+
+governor = ResourceGovernor()
+metrics.gauges["memory"] = governor.describe
@@ -1,4 +1,4 @@
-from typing import Optional, List, Tuple, Callable, Dict, Union
+from typing import Optional, List, Tuple, Callable, Dict, Union, Awaitable, Any
 import discord
 from bs4 import BeautifulSoup as BS
 from discord.ext import commands
@@ -6,14 +6,29 @@ import PIL.Image
 import PIL.ImageOps
 import PIL.ImageFilter
 import PIL.ImageEnhance
+import PIL.ImageFile
 import io
 import asyncio
+import functools
+import math
+import time
+import cProfile
+import pstats
+import marshal
 import urllib.request
 import random
 
-from .bot import bot
+from .bot import bot, remember_deletable, is_owner, ErrorWithMessage
+from .singleflight import SingleFlight
+from . import metrics
+from .outbound import outbound
+from . import convolution
+from .workers import pool, JobTimeout
+from .governor import process_rss, peak_rss, reset_peak_rss
 
-def limit_size(image: PIL.Image.Image, maxsize: int = 2000 * 2000) -> PIL.Image.Image:
+MAX_PIXELS = 2000 * 2000
+
+def limit_size(image: PIL.Image.Image, maxsize: int = MAX_PIXELS) -> PIL.Image.Image:
 	width, height = image.size
 	size = width * height
 	if size < maxsize:
@@ -36,32 +51,150 @@ def make_file_from_image(image: PIL.Image.Image, filename: str, *, quality: int
 	file = discord.File(outfile, filename + "." + format)
 	return file
 
+# Images are kept in their native mode if it is one of these, and only promoted (see promote())
+# when a manipulator can't work on that mode. Greyscale and palette images are 1/4 the size of RGBA.
+COMPACT_MODES = ("L", "LA", "P", "RGB", "RGBA")
+FILTERABLE_MODES = ("L", "LA", "RGB", "RGBA") # PIL can't filter palette images
+ALPHA_MODES = ("LA", "RGBA") # for manipulators that expose new (transparent) area
+COLOR_MODES = ("RGB", "RGBA") # default, for manipulators that work on color channels
+
+def has_alpha(image: PIL.Image.Image) -> bool:
+	return image.mode in ("LA", "RGBA", "PA") or "transparency" in image.info
+
+def promote(image: PIL.Image.Image, modes: Tuple[str, ...]) -> PIL.Image.Image:
+	"Convert @param image to the most compact of @param modes that loses no information"
+	if image.mode in modes:
+		return image
+	if image.mode == "L" and has_alpha(image):
+		candidates = ("LA", "RGBA")
+	elif image.mode == "L":
+		candidates = ("LA", "RGB", "RGBA")
+	elif image.mode in ("LA", "RGB") or has_alpha(image):
+		candidates = ("RGBA",)
+	else:
+		candidates = ("RGB", "RGBA")
+	for mode in candidates:
+		if mode in modes:
+			return image.convert(mode)
+	return image.convert("RGBA")
+
 def make_image_from_bytes(bs: bytes) -> PIL.Image.Image:
 	infile = io.BytesIO(bs)
-	image = PIL.Image.open(infile).convert("RGBA")
+	image = PIL.Image.open(infile)
+	if image.format == "JPEG" and image.width * image.height > MAX_PIXELS:
+		# let libjpeg scale down while decoding (by 1/2, 1/4 or 1/8) instead of decoding full size and resizing after
+		scale = math.sqrt(MAX_PIXELS / (image.width * image.height))
+		image.draft(image.mode, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+	if image.mode not in COMPACT_MODES:
+		image = image.convert({"1": "L", "CMYK": "RGB", "YCbCr": "RGB"}.get(image.mode, "RGBA"))
+	elif image.mode in ("L", "RGB") and "transparency" in image.info:
+		# a colour key (PNG tRNS) only survives conversion, and manipulators would change the pixels under it; make it real alpha
+		image = image.convert(image.mode + "A")
 	image = PIL.ImageOps.exif_transpose(image)
 	return image
 
-def make_image_from_url(url: str) -> PIL.Image.Image:
+# Identical work that is already in flight (e.g. several people running >jpeg on the same just-posted image)
+# is done once and shared: downloads are keyed by url, decodes by source url, and results by source url and chain.
+fetches = SingleFlight("fetch")
+decodes = SingleFlight("decode")
+pipelines = SingleFlight("pipeline")
+for flight in (fetches, decodes, pipelines):
+	metrics.gauges[flight.name + "_coalesced"] = lambda flight=flight: "{} of {}".format(flight.coalesced, flight.started + flight.coalesced)
+
+SOURCE_KEY = "needsmorejpeg.source"
+
+def source_key(image: PIL.Image.Image) -> Optional[str]:
+	"The url a decoded source image came from, if it came from one"
+	return image.info.get(SOURCE_KEY)
+
+PROBE_SIZE = 16 * 1024 # enough for the header (format and dimensions) of any common image format
+MAX_IMAGE_DOWNLOAD = 50 * 1024 * 1024
+MAX_PAGE_DOWNLOAD = 2 * 1024 * 1024 # webpages are only searched for <img> tags
+
+def probe_image(head: bytes) -> Optional[Tuple[str, Tuple[int, int]]]:
+	"Format and dimensions of the image starting with @param head, if its header is in there"
+	parser = PIL.ImageFile.Parser()
+	try:
+		parser.feed(head)
+	except Exception:
+		return None
+	if parser.image is None:
+		return None
+	return parser.image.format, parser.image.size
+
+IMAGE_SIGNATURES = (b"\xFF\xD8\xFF", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a", b"II*\x00", b"MM\x00*", b"BM")
+
+def looks_like_image(head: bytes) -> bool:
+	"Whether @param head starts like an image, even if its header runs past it (e.g. a JPEG with large EXIF/APP segments)"
+	return head.startswith(IMAGE_SIGNATURES) or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+
+def looks_like_html(head: bytes) -> bool:
+	start = head.lstrip()[:64].lower()
+	return start.startswith(b"<!doctype html") or start.startswith(b"<html") or b"<head" in start
+
+def read_url(url: str) -> bytes:
+	"""Download @param url, deciding from the first PROBE_SIZE bytes whether the rest is worth fetching.
+	Raises ValueError for things that are neither images nor webpages (videos, archives, ...) or are too big."""
 	request = urllib.request.Request(url, None, headers)
 	response = urllib.request.urlopen(request)
 	if not response:
 		raise FileNotFoundError(url)
+	with response:
+		head = response.read(PROBE_SIZE)
+		content_type = response.headers.get_content_type()
+		length = int(response.headers.get("Content-Length") or 0)
+		probed = probe_image(head)
+		if probed is not None:
+			format, (width, height) = probed
+			if width * height > 2 * PIL.Image.MAX_IMAGE_PIXELS: # what PIL.Image.open would refuse anyway
+				metrics.count("probe_skipped_bomb")
+				raise PIL.Image.DecompressionBombError("{} is {}x{}".format(url, width, height))
+			limit = MAX_IMAGE_DOWNLOAD
+		elif content_type in ("text/html", "application/xhtml+xml") or looks_like_html(head):
+			limit = MAX_PAGE_DOWNLOAD
+		elif content_type.startswith("image/") or looks_like_image(head): # a header we couldn't read (yet); let PIL try
+			limit = MAX_IMAGE_DOWNLOAD
+		else:
+			metrics.count("probe_skipped_type")
+			raise ValueError("{} is {}, not an image".format(url, content_type))
+		if limit == MAX_IMAGE_DOWNLOAD and length > limit:
+			metrics.count("probe_skipped_size")
+			raise ValueError("{} is too big ({} bytes)".format(url, length))
+		body = head + response.read(limit + 1 - len(head))
+		if len(body) > limit:
+			if limit == MAX_IMAGE_DOWNLOAD: # no (or a wrong) Content-Length
+				metrics.count("probe_skipped_size")
+				raise ValueError("{} is too big".format(url))
+			body = body[:limit] # webpages are cut off rather than refused
+		metrics.count("probe_downloaded")
+		return body
+
+async def fetch_url(url: str) -> bytes:
+	loop = asyncio.get_event_loop()
+	return await fetches.do(url, lambda: loop.run_in_executor(None, read_url, url))
+
+async def decode_image(key: str, bs: bytes) -> PIL.Image.Image:
+	"Decode @param bs (downloaded from @param key) off the event loop. The result is shared, so it must not be modified in place."
+	loop = asyncio.get_event_loop()
+	async def decode():
+		image = await loop.run_in_executor(None, make_image_from_bytes, bs)
+		image.info[SOURCE_KEY] = key
+		return image
+	return await decodes.do(key, decode)
+
+async def make_image_from_url(url: str) -> PIL.Image.Image:
+	bs = await fetch_url(url)
 	try:
-		return make_image_from_bytes(response.read())
+		return await decode_image(url, bs)
 	except PIL.UnidentifiedImageError as ex:
-		soup = BS(response)
+		soup = BS(bs, "html.parser")
 		for img_tag in soup.find_all('img'):
 		# ) if img_src.startswith("https://") or img_src.startswith("http://")):
-			img_src = img_tag['src']
+			img_src = img_tag.get('src', '')
 			if img_src.startswith("https://") or img_src.startswith("http://"):
 				try:
-					request = urllib.request.Request(img_src, None, headers)
-					response = urllib.request.urlopen(request)
-					if not response:
-						continue
-					return make_image_from_bytes(response.read())
-				except PIL.UnidentifiedImageError as ex:
+					return await decode_image(img_src, await fetch_url(img_src))
+				except (PIL.UnidentifiedImageError, FileNotFoundError, ValueError) as ex: # ValueError: not an image, or too big (see read_url)
 					continue
 	raise ValueError("webpage at url did not contain any valid <img> tags")
 
@@ -69,7 +202,7 @@ async def get_images_from_message(message: discord.Message, *, ignore_text: bool
 	images: List[Image_with_info] = []
 	for attachment in message.attachments:
 		try:
-			image = make_image_from_bytes(await attachment.read())
+			image = await decode_image(attachment.url, await fetches.do(attachment.url, attachment.read))
 			images.append((image, message.author, str(attachment.filename)))
 		except discord.DiscordException:
 			raise
@@ -77,7 +210,7 @@ async def get_images_from_message(message: discord.Message, *, ignore_text: bool
 		if embed.image:
 			url: str = embed.image.url
 			try:
-				image = make_image_from_url(url)
+				image = await make_image_from_url(url)
 				images.append((image, message.author, "image0"))
 			except (discord.DiscordException, FileNotFoundError) as ex:
 				if not ignore_exceptions:
@@ -90,7 +223,7 @@ async def get_images_from_message(message: discord.Message, *, ignore_text: bool
 			if not url.startswith('http'):
 				continue
 			try:
-				image = make_image_from_url(url)
+				image = await make_image_from_url(url)
 				images.append((image, message.author, "image0"))
 			except ValueError as ve: # unknown url type
 				#print(141, ve)
@@ -101,7 +234,8 @@ async def get_images_from_message(message: discord.Message, *, ignore_text: bool
 	return images
 
 async def get_avatar_image(member: discord.Member) -> Image_with_info:
-	image = make_image_from_bytes(await member.avatar_url.read())
+	url = str(member.avatar_url)
+	image = await decode_image(url, await fetches.do(url, member.avatar_url.read))
 	return (image, member, str(member.id))
 
 async def find_images_from_context(ctx, *, ignore_first_text: bool = False) -> List[Image_with_info]:
@@ -124,25 +258,104 @@ async def find_images_from_context(ctx, *, ignore_first_text: bool = False) -> L
 	return images
 
 
+PREVIEW_FLAG = "--preview"
+PREVIEW_LATENCY_TARGET = 2.0 # seconds from starting the preview run to having it posted
+preview_pixels = 400 * 400 # adjusted at runtime to keep previews within the latency target
+PREVIEW_PIXELS_MIN = 128 * 128
+PREVIEW_PIXELS_MAX = 800 * 800
+
+def _adjust_preview_size(seconds: float) -> None:
+	global preview_pixels
+	if seconds > PREVIEW_LATENCY_TARGET:
+		metrics.count("preview_over_target")
+		preview_pixels = max(PREVIEW_PIXELS_MIN, int(preview_pixels * 0.7))
+	elif seconds < PREVIEW_LATENCY_TARGET / 4:
+		preview_pixels = min(PREVIEW_PIXELS_MAX, int(preview_pixels * 1.2))
+
+async def post_result(ctx, image: PIL.Image.Image, author: discord.Member, filename: str, run: Callable[[PIL.Image.Image], Awaitable[PIL.Image.Image]], job: Tuple, *, preview: bool = False) -> Optional[asyncio.Task]:
+	"""Run @param run on @param image and post the result. @param job identifies the work (for coalescing identical requests).
+	With @kwparam preview, the full-size job starts in the background alongside a downscaled one; the downscaled
+	result is posted first, and the returned task posts the full-size result in its place (or just removes the
+	preview if the full-size job fails)."""
+	key = source_key(image)
+	def compute(image: PIL.Image.Image, job: Tuple) -> Awaitable[PIL.Image.Image]:
+		return run(image) if key is None else pipelines.do((key, *job), functools.partial(run, image))
+	text = "{0} or {1} may delete this by reacting ❌".format(ctx.message.author.mention, author.mention)
+
+	async def post(image: PIL.Image.Image, text: str) -> discord.Message:
+		# allowed_mentions = discord.AllowedMentions(everyone = False, users = False, roles = False)
+		# message = await ctx.send(text, file=file, allowed_mentions=allowed_mentions)
+		async with outbound.upload(ctx.channel):
+			message = await ctx.send(text, file=make_file_from_image(image, filename=filename))
+		remember_deletable(message, (ctx.message.author.id, author.id))
+		outbound.add_reaction(message, "❌")
+		return message
+
+	small = limit_size(image, preview_pixels) if preview else image
+	start = time.perf_counter()
+	if small is image:
+		await post(await compute(image, job), text)
+		metrics.record("full", time.perf_counter() - start)
+		return None
+
+	result = asyncio.ensure_future(compute(image, job))
+	try:
+		preview_message = await post(await compute(small, ("preview", small.size, *job)), text + " (preview, full size coming)")
+	except BaseException:
+		result.cancel()
+		raise
+	seconds = time.perf_counter() - start
+	metrics.record("preview", seconds)
+	_adjust_preview_size(seconds)
+
+	async def full() -> None:
+		try:
+			await post(await result, text)
+			metrics.record("full", time.perf_counter() - start)
+		finally:
+			# discord.py can't replace a message's attachment, so the preview is swapped out by deleting it
+			try:
+				await preview_message.delete()
+			except discord.HTTPException: # e.g. already deleted with ❌
+				pass
+	return asyncio.ensure_future(full())
+
+async def post_results(ctx, images: List[Image_with_info], run: Callable[[PIL.Image.Image], Awaitable[PIL.Image.Image]], job: Tuple, *, preview: bool = False) -> None:
+	"post_result for each of @param images. With @kwparam preview, every preview is posted before waiting on the full-size results."
+	finishers: List[asyncio.Task] = []
+	try:
+		for image, author, filename in images:
+			finish = await post_result(ctx, image, author, filename, run, job, preview=preview)
+			if finish is not None:
+				finishers.append(finish)
+		await asyncio.gather(*finishers)
+	finally:
+		for finish in finishers: # if anything failed or the command was cancelled, don't leave full-size jobs running
+			finish.cancel()
+
+def parse_arg(typ: type, arg: str) -> Any:
+	"Convert a command argument to @param typ, rejecting inf and nan (which no manipulator can do anything sensible with)"
+	value = typ(arg)
+	if isinstance(value, float) and not math.isfinite(value):
+		raise ValueError("{} is not a finite number".format(arg))
+	return value
+
 def command_from_image_manipulator(func: Callable[[PIL.Image.Image], PIL.Image.Image], /, argtypes: Tuple = ()):
 	if func is None:
 		raise ValueError
 	async def command(ctx: discord.ext.commands.Context, *args):
+		preview = args[:1] == (PREVIEW_FLAG,)
+		if preview:
+			args = args[1:]
 		if argtypes:
-			args = tuple([typ(arg) for typ, arg in zip(argtypes, args)])
+			args = tuple([parse_arg(typ, arg) for typ, arg in zip(argtypes, args)])
 		else:
 			args = ()
+		run = lambda image: run_job(image, [(func, list(args))])
+		track_command(ctx)
 		async with ctx.typing():
 			images = await find_images_from_context(ctx, ignore_first_text = (len(argtypes)>0))
-			for image, author, filename in images:
-				#print(args)
-				#modified_image = func(image, *args)
-				modified_image = limit_size(func(image, *args))
-				file = make_file_from_image(modified_image, filename=filename)
-				# allowed_mentions = discord.AllowedMentions(everyone = False, users = False, roles = False)
-				# message = await ctx.send("{0} or {1} may delete this by reacting ❌".format(ctx.message.author.mention, author.mention), file=file, allowed_mentions=allowed_mentions)
-				message = await ctx.send("{0} or {1} may delete this by reacting ❌".format(ctx.message.author.mention, author.mention), file=file)
-				await message.add_reaction("❌")
+			await post_results(ctx, images, run, (func.__name__, args), preview=preview)
 	command.__name__ = func.__name__
 	command.__doc__ = func.__doc__
 	return command
@@ -166,11 +379,18 @@ def image_manipulator(func: Optional[Callable[..., PIL.Image.Image]] = None, \
 					  *, \
 					  name: Optional[str] = None, \
 					  names: Optional[List[str]] = None, \
-					  argtypes: Optional[Tuple] = ()
+					  argtypes: Optional[Tuple] = (), \
+					  modes: Tuple[str, ...] = COLOR_MODES, \
+					  variance: Optional[Callable[..., float]] = None, \
+					  cost: float = 1.0
 					 ):
+	"""@kwparam cost is roughly how many simple full-image passes (like a flip) the manipulator costs, for the job cost model.
+	@kwparam modes are the image modes @param func works on directly; other images are promoted to one of them first.
+	For blurs, @kwparam variance gives the per-axis variance of the kernel for the manipulator's arguments,
+	so that consecutive blurs in a manipulate chain can be merged into a single Gaussian."""
 	if func is None:
 		def wrapper(f: "Callable[[PIL.Image.Image, ...], PIL.Image.Image]" = None):
-			return image_manipulator(f, name=name, names=names, argtypes=argtypes)
+			return image_manipulator(f, name=name, names=names, argtypes=argtypes, modes=modes, variance=variance, cost=cost)
 		return wrapper
 	import inspect
 	if inspect.iscoroutinefunction(func):
@@ -183,72 +403,207 @@ def image_manipulator(func: Optional[Callable[..., PIL.Image.Image]] = None, \
 	elif name is not None:
 		names = [name]
 	
+	@functools.wraps(func)
+	def promoting(image: PIL.Image.Image, *args) -> PIL.Image.Image:
+		return func(promote(image, modes), *args)
+	promoting.modes = modes
+	promoting.variance = variance
+	promoting.cost = cost
+
 	for name in names:
-		image_manipulators[name] = (func, argtypes)
-		bot.command(name=name)(command_from_image_manipulator(func, argtypes=argtypes))
+		image_manipulators[name] = (promoting, argtypes)
+		bot.command(name=name)(command_from_image_manipulator(promoting, argtypes=argtypes))
 	return func # So the function can be used elsewhere
 
-@bot.command()
-async def manipulate(ctx, *args: str):
-	"""Manipulate an image
-	Any sequence of image manipulation commands (e.g. invert, jpeg, rotate <degrees>) may be used.
-	Syntax:
-	>manipulate <command1> [command1 args (if any)] [<command1> [command2 args (if any)]] ...
-	Example:
-	>manipulate rotate 45 jpeg invert rotate -45
-	"""
-	def applier(*funcs):
-		async def apply(image):
-			for f in funcs:
-				#image = f(image)
-				await asyncio.sleep(0)
-				image = limit_size(f(image))
-			return image
-		return apply
-	
-	funcs = []
+def merged_blur(image: PIL.Image.Image, variance: float) -> PIL.Image.Image:
+	# clamped like gblur: everything is one smear past this anyway, and huge radii make huge padded arrays
+	return convolution.gaussian_blur(promote(image, FILTERABLE_MODES), min(math.sqrt(variance), max(image.size)))
+merged_blur.cost = 4
+
+def merge_blurs(steps: List[Tuple[Callable, List]]) -> List[Tuple[Callable, List]]:
+	"Replace each run of two or more consecutive blurs with one Gaussian of the same total variance (variances add under convolution)"
+	merged = []
+	run = []
+	for step in steps + [(None, [])]:
+		manipulator, func_args = step
+		if manipulator is not None and manipulator.variance is not None:
+			run.append(step)
+			continue
+		if len(run) > 1:
+			merged.append((merged_blur, [sum(m.variance(*a) for m, a in run)]))
+		else:
+			merged += run
+		run = []
+		if manipulator is not None:
+			merged.append(step)
+	return merged
+
+# Budgets for a single image job. The CPU budget is checked between steps; the wall-clock one is enforced by killing the worker.
+JOB_TIMEOUT = 60.0
+JOB_CPU_BUDGET = 45.0
+MAX_CHAIN_LENGTH = 200
+MAX_JOB_COST = 300.0 # in megapixel-passes; see job_cost()
+
+def job_cost(size: Tuple[int, int], steps: List[Tuple[Callable, List]]) -> float:
+	"Rough cost of running @param steps on an image of @param size, in megapixel-passes"
+	megapixels = min(size[0] * size[1], 2000 * 2000) / 1e6 # limit_size caps every intermediate
+	return sum(manipulator.cost for manipulator, func_args in steps) * megapixels
+
+def resolve_manipulator(name: str) -> Callable[..., PIL.Image.Image]:
+	if name == merged_blur.__name__:
+		return merged_blur
+	return image_manipulators[name][0]
+
+def run_chain(image: PIL.Image.Image, steps: List[Tuple[str, List]], cpu_budget: float) -> PIL.Image.Image:
+	"Run in a worker process: apply each (manipulator name, arguments) step to @param image"
+	start = time.process_time()
+	for name, func_args in steps:
+		if time.process_time() - start > cpu_budget:
+			raise JobTimeout
+		image = limit_size(resolve_manipulator(name)(image, *func_args))
+	image.load()
+	return image
+
+def profile_chain(image: PIL.Image.Image, steps: List[Tuple[str, List]]) -> Tuple[List[Tuple], Optional[int], Optional[int], bool, str, bytes]:
+	"""Run in a worker process: like run_chain, but returns per-stage (name, seconds, size, mode, RSS after) tuples, the RSS at
+	the start and its peak (which, unlike tracemalloc, includes PIL's own buffers), whether the peak covers only this run,
+	and the hottest functions as text and as marshalled pstats"""
+	peak_is_this_run = reset_peak_rss()
+	start_rss = process_rss()
+	stages = []
+	profiler = cProfile.Profile()
+	for name, func_args in steps:
+		start = time.perf_counter()
+		profiler.enable()
+		image = limit_size(resolve_manipulator(name)(image, *func_args))
+		image.load()
+		profiler.disable()
+		stages.append(("{} {}".format(name, " ".join(map(str, func_args))).strip(), time.perf_counter() - start, image.size, image.mode, process_rss()))
+	hot = io.StringIO()
+	stats = pstats.Stats(profiler, stream=hot)
+	stats.sort_stats("tottime").print_stats(10)
+	return stages, start_rss, peak_rss(), peak_is_this_run, hot.getvalue(), marshal.dumps(stats.stats)
+
+async def run_job(image: PIL.Image.Image, steps: List[Tuple[Callable, List]]) -> PIL.Image.Image:
+	"Run @param steps on @param image in a worker process, rejecting it up front if the cost model says it is too big"
+	cost = job_cost(image.size, steps)
+	if cost > MAX_JOB_COST:
+		metrics.count("jobs_rejected")
+		raise ErrorWithMessage("That would take too long ({:.0f} units of work; the limit is {:.0f}). Try fewer steps or a smaller image.".format(cost, MAX_JOB_COST))
+	try:
+		return await pool.run(run_chain, image, [(manipulator.__name__, func_args) for manipulator, func_args in steps], JOB_CPU_BUDGET, timeout=JOB_TIMEOUT)
+	except JobTimeout:
+		metrics.count("jobs_timed_out")
+		raise ErrorWithMessage("That took too long, so I gave up on it.")
+
+# message id -> the command task working on it, so deleting the message cancels the job
+running_commands: Dict[int, asyncio.Task] = {}
+
+def track_command(ctx) -> None:
+	task = asyncio.current_task()
+	running_commands[ctx.message.id] = task
+	task.add_done_callback(lambda task: running_commands.pop(ctx.message.id, None))
+
+@bot.listen()
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+	task = running_commands.pop(payload.message_id, None)
+	if task is not None:
+		metrics.count("jobs_cancelled")
+		task.cancel()
+
+async def parse_chain(ctx, args: Tuple[str, ...]) -> Optional[List[Tuple[Callable, List]]]:
+	"Parse a manipulate-style chain into (manipulator, arguments) steps, or complain and return None"
+	steps = []
 	
 	i: int = 0
 	while i < len(args):
 		try:
 			manipulator, argtypes = image_manipulators[args[i]]
 		except KeyError:
-			await ctx.message.add_reaction("⚠")
+			outbound.add_reaction(ctx.message, "⚠")
 			await ctx.send("Unknown image manipulator: {}".format(args[i]), delete_after=5)
-			return
+			return None
 		func_args = []
 		for j, typ in enumerate(argtypes):
 			try:
-				func_args.append(typ(args[i + 1 + j]))
+				func_args.append(parse_arg(typ, args[i + 1 + j]))
 			except ValueError:
-				await ctx.message.add_reaction("⚠")
+				outbound.add_reaction(ctx.message, "⚠")
 				await ctx.send("Invalid argument #{} for manipulator {}: {} (expected {})" \
 							   	.format(j, args[i], repr(args[i + j]), typ),
 							   delete_after=5)
-				return
+				return None
 			except IndexError:
-				await ctx.message.add_reaction("⚠")
+				outbound.add_reaction(ctx.message, "⚠")
 				await ctx.send("Not enough arguments for manipulator {}: got {} (expected {})" \
 							   	.format(args[i], j, len(argtypes)),
 							   delete_after=5)
-				return
+				return None
 		#print(i, args[i], len(argtypes), func_args)
 		i += 1 + len(argtypes)
-		funcs.append(lambda image, func_args=func_args, manipulator=manipulator: manipulator(image, *func_args))
+		steps.append((manipulator, func_args))
+	return steps
+
+@bot.command()
+async def manipulate(ctx, *args: str):
+	"""Manipulate an image
+	Any sequence of image manipulation commands (e.g. invert, jpeg, rotate <degrees>) may be used.
+	Syntax:
+	>manipulate <command1> [command1 args (if any)] [<command1> [command2 args (if any)]] ...
+	Example:
+	>manipulate rotate 45 jpeg invert rotate -45
+	Start with --preview to get a quick low-resolution result first.
+	"""
+	preview = args[:1] == (PREVIEW_FLAG,)
+	if preview:
+		args = args[1:]
+	steps = await parse_chain(ctx, args)
+	if steps is None:
+		return
 	
-	func = applier(*funcs)
-	await ctx.message.add_reaction("🔜")
+	steps = merge_blurs(steps)
+	if len(steps) > MAX_CHAIN_LENGTH:
+		raise ErrorWithMessage("That chain has {} steps; the most I'll run is {}".format(len(steps), MAX_CHAIN_LENGTH))
+	func = lambda image: run_job(image, steps)
+	track_command(ctx)
+	outbound.add_reaction(ctx.message, "🔜")
 	async with ctx.typing():
 		images = await find_images_from_context(ctx, ignore_first_text = True)
-		for image, author, filename in images:
-			#print(args)
-			modified_image = await func(image)
-			file = make_file_from_image(modified_image, filename=filename)
-			# allowed_mentions = discord.AllowedMentions(everyone = False, users = False, roles = False)
-			# message = await ctx.send("{0} or {1} may delete this by reacting ❌".format(ctx.message.author.mention, author.mention), file=file, allowed_mentions=allowed_mentions)
-			message = await ctx.send("{0} or {1} may delete this by reacting ❌".format(ctx.message.author.mention, author.mention), file=file)
-			await message.add_reaction("❌")
-	await ctx.message.remove_reaction("🔜", bot.user)
+		await post_results(ctx, images, func, args, preview=preview)
+	outbound.remove_own_reaction(ctx.message, "🔜", bot.user)
+
+@bot.command(hidden=True)
+@commands.check(is_owner)
+async def profile(ctx, *args: str):
+	"""Profile a manipulate chain on the referenced image
+	Replies with per-stage timings and RSS, the hottest functions, peak RSS, and a .prof file (for snakeviz, pstats, etc.).
+	Syntax is the same as >manipulate."""
+	steps = await parse_chain(ctx, args)
+	if steps is None:
+		return
+	async with ctx.typing():
+		images = await find_images_from_context(ctx, ignore_first_text = True)
+		if not images:
+			outbound.add_reaction(ctx.message, "⚠")
+			await ctx.send("No image to profile", delete_after=5)
+			return
+		image, author, filename = images[0]
+
+		# in a worker, so the peak RSS is this chain's (PIL's buffers included) rather than the whole bot's
+		named_steps = [(manipulator.__name__, func_args) for manipulator, func_args in merge_blurs(steps)]
+		try:
+			stages, start_rss, peak, peak_is_this_run, hot_functions, prof = await pool.run(profile_chain, image, named_steps, timeout=JOB_TIMEOUT)
+		except JobTimeout:
+			raise ErrorWithMessage("That took too long, so I gave up on it.")
+
+		def mib(n: Optional[int]) -> str:
+			return "?" if n is None else "{:.1f} MiB".format(n / 2**20)
+		lines = ["Input: {}x{} {}, worker RSS {}".format(*image.size, image.mode, mib(start_rss))]
+		lines += ["{:>8.1f}ms  {} -> {}x{} {}, RSS {}".format(seconds * 1000, name, *size, mode, mib(rss)) for name, seconds, size, mode, rss in stages]
+		lines.append("Total: {:.1f}ms, peak RSS: {}{}".format(sum(stage[1] for stage in stages) * 1000, mib(peak), "" if peak_is_this_run else " (since the worker started)"))
+		hot_functions = hot_functions[hot_functions.find("   ncalls"):].rstrip()
+		text = "```\n{}\n\n{}".format('\n'.join(lines), hot_functions)[:1990] + "\n```"
+		await ctx.send(text, file=discord.File(io.BytesIO(prof), filename + ".prof"))
 
 @bot.command()
 async def delete(ctx, message: Optional[discord.Message] = None):
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+from typing import Dict, List, Callable, Deque
+import collections
+import contextlib
+import time
+
+class Timing:
+	"Running latency statistics for one kind of event, with a window of recent samples for percentiles"
+	def __init__(self, window: int = 256):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.recent: Deque[float] = collections.deque(maxlen=window)
+
+	def add(self, seconds: float) -> None:
+		self.count += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+		self.recent.append(seconds)
+
+	def percentile(self, p: float) -> float:
+		if not self.recent:
+			return 0.0
+		ordered = sorted(self.recent)
+		return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+	def describe(self) -> str:
+		if not self.count:
+			return "no samples"
+		return "n={} mean={:.3f}s p50={:.3f}s p95={:.3f}s max={:.3f}s".format(
+			self.count, self.total / self.count, self.percentile(50), self.percentile(95), self.max)
+
+timings: Dict[str, Timing] = collections.defaultdict(Timing)
+counters: Dict[str, int] = collections.Counter()
+# name -> function returning the current value, for state owned elsewhere (queues, caches, ...)
+gauges: Dict[str, Callable[[], object]] = {}
+
+def record(name: str, seconds: float) -> None:
+	timings[name].add(seconds)
+
+def count(name: str, n: int = 1) -> None:
+	counters[name] += n
+
+@contextlib.contextmanager
+def timed(name: str):
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		record(name, time.perf_counter() - start)
+
+def summary() -> List[str]:
+	lines = ["{}: {}".format(name, timing.describe()) for name, timing in sorted(timings.items())]
+	lines += ["{}: {}".format(name, value) for name, value in sorted(counters.items())]
+	lines += ["{}: {}".format(name, gauge()) for name, gauge in sorted(gauges.items())]
+	return lines
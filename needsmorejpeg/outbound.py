@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+from typing import Optional, Dict, Tuple, Callable, Awaitable
+import collections
+import contextlib
+import asyncio
+import time
+import discord
+
+from . import metrics
+
+MAX_AGE = 30.0 # cosmetic calls that have waited longer than this are dropped
+MAX_UPLOAD_WAIT = 5.0 # cosmetic calls wait at most this long (since being queued) for uploads in their channel
+REACTION_INTERVAL = 0.25 # Discord allows about one reaction change per channel every 250ms
+
+class RateBucket:
+	"Local estimate of one rate limit bucket, so calls wait here instead of running into a 429"
+	def __init__(self, interval: float):
+		self.interval = interval
+		self.next_free = 0.0
+
+	async def acquire(self) -> None:
+		now = time.monotonic()
+		if self.next_free > now:
+			await asyncio.sleep(self.next_free - now)
+		self.next_free = max(now, self.next_free) + self.interval
+
+	def back_off(self, seconds: float) -> None:
+		self.next_free = max(self.next_free, time.monotonic() + seconds)
+
+class Call:
+	def __init__(self, bucket: Tuple, func: Callable[[], Awaitable]):
+		self.bucket = bucket
+		self.func = func
+		self.queued = time.monotonic()
+
+class Outbound:
+	"""Sends cosmetic API calls (reactions) in the background, after any file uploads in flight in the same channel.
+	Each rate limit bucket has its own queue, so a busy channel doesn't hold up the others.
+	A queued reaction add and a queued remove of the same reaction cancel out, duplicates are
+	sent once, and calls older than MAX_AGE are dropped."""
+	def __init__(self):
+		# bucket -> (message id, emoji, "add"/"remove") -> call, for this bot's own reactions
+		self.pending: Dict[Tuple, "collections.OrderedDict[Tuple, Call]"] = {}
+		self.buckets: Dict[Tuple, RateBucket] = {}
+		self.uploads: Dict[int, int] = {} # channel id -> uploads in flight
+		self._uploads_done: Dict[int, asyncio.Event] = {}
+		self._workers: Dict[Tuple, asyncio.Task] = {}
+
+	@contextlib.asynccontextmanager
+	async def upload(self, channel: discord.abc.Snowflake):
+		"Wrap file uploads to @param channel in this so cosmetic calls in that channel wait for them"
+		self.uploads[channel.id] = self.uploads.get(channel.id, 0) + 1
+		if channel.id not in self._uploads_done:
+			self._uploads_done[channel.id] = asyncio.Event()
+		try:
+			yield
+		finally:
+			self.uploads[channel.id] -= 1
+			if not self.uploads[channel.id]:
+				del self.uploads[channel.id]
+				self._uploads_done.pop(channel.id).set()
+
+	async def _wait_for_uploads(self, channel_id: int, queued: float) -> None:
+		"Wait for uploads in flight in @param channel_id, but not past MAX_UPLOAD_WAIT after @param queued"
+		done = self._uploads_done.get(channel_id)
+		timeout = queued + MAX_UPLOAD_WAIT - time.monotonic()
+		if done is None or timeout <= 0:
+			return
+		try:
+			await asyncio.wait_for(done.wait(), timeout)
+		except asyncio.TimeoutError: # the channel is never quiet; don't let reactions go stale waiting for it
+			metrics.count("outbound_upload_wait_expired")
+
+	def _queue(self, message: discord.Message, emoji: str, action: str, func: Callable[[], Awaitable]) -> None:
+		bucket = ("reaction", message.channel.id)
+		pending = self.pending.setdefault(bucket, collections.OrderedDict())
+		key = (message.id, emoji)
+		opposite = key + ("remove" if action == "add" else "add",)
+		if opposite in pending: # e.g. a 🔜 that is removed before it was ever added
+			del pending[opposite]
+			metrics.count("outbound_cancelled", 2)
+			return
+		if key + (action,) in pending:
+			metrics.count("outbound_coalesced")
+			return
+		pending[key + (action,)] = Call(bucket, func)
+		worker = self._workers.get(bucket)
+		if worker is None or worker.done():
+			self._workers[bucket] = asyncio.ensure_future(self._work(bucket, message.channel.id))
+
+	def add_reaction(self, message: discord.Message, emoji: str) -> None:
+		self._queue(message, emoji, "add", lambda: message.add_reaction(emoji))
+
+	def remove_own_reaction(self, message: discord.Message, emoji: str, me: discord.abc.Snowflake) -> None:
+		"Remove a reaction this bot added with add_reaction (@param me is the bot's user)"
+		self._queue(message, emoji, "remove", lambda: message.remove_reaction(emoji, me))
+
+	def _bucket(self, key: Tuple) -> RateBucket:
+		if key not in self.buckets:
+			self.buckets[key] = RateBucket(REACTION_INTERVAL)
+		return self.buckets[key]
+
+	async def _work(self, bucket_key: Tuple, channel_id: int) -> None:
+		pending = self.pending[bucket_key]
+		bucket = self._bucket(bucket_key)
+		try:
+			while pending:
+				await self._wait_for_uploads(channel_id, next(iter(pending.values())).queued)
+				if not pending:
+					break
+				_, call = pending.popitem(last=False)
+				if time.monotonic() - call.queued > MAX_AGE:
+					metrics.count("outbound_dropped_stale")
+					continue
+				await bucket.acquire()
+				try:
+					await call.func()
+					metrics.count("outbound_sent")
+				except discord.HTTPException as ex:
+					if ex.status == 429:
+						metrics.count("outbound_rate_limited")
+						bucket.back_off(float(getattr(ex.response, "headers", {}).get("Retry-After", 1)))
+					# otherwise (message deleted, missing permissions, ...) there is nothing useful to do
+		finally:
+			if not pending and self.pending.get(bucket_key) is pending:
+				del self.pending[bucket_key]
+				del self._workers[bucket_key]
+
+	def describe(self) -> str:
+		return "{} pending in {} channels, {} uploads in flight".format(sum(map(len, self.pending.values())), len(self.pending), sum(self.uploads.values()))
+
+outbound = Outbound()
+metrics.gauges["outbound"] = outbound.describe
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Golden-image regression and benchmark harness for the image manipulators.
+#
+#   python -m needsmorejpeg.regression            check outputs against golden_fingerprints.json and time every case
+#   python -m needsmorejpeg.regression --update   rewrite golden_fingerprints.json from the current code
+#
+# Outputs are compared by fingerprint: per-channel block means (the colours and layout) and block
+# detail (mean gradient, which blurring, sharpening and jpeg artifacts all change) on a coarse grid.
+# A case fails when either map moves by more than its tolerance on average, so harmless changes like
+# a different libjpeg or rounding don't fail, but visible changes, including a filter becoming a
+# no-op, do. Timings are compared with the ones stored alongside the fingerprints, so one run shows
+# both whether an optimization changed the output and how much faster or slower it made each case.
+from typing import Dict, List, Tuple, Callable, Optional
+import argparse
+import base64
+import io
+import json
+import math
+import os
+import sys
+import time
+import numpy as np
+import PIL.Image
+
+from . import commands # registers the manipulators
+from .image_manipulator import image_manipulators, merge_blurs, limit_size, make_image_from_bytes
+
+GOLDEN_FILE = os.path.join(os.path.dirname(__file__), "golden_fingerprints.json")
+FINGERPRINT_SIZE = (16, 12)
+DEFAULT_TOLERANCE = 2.5 # mean absolute difference of a fingerprint map, in levels out of 255
+
+# arguments for manipulators that take some; anything not listed gets defaults by type
+sample_args: Dict[str, Tuple] = {
+	"rotate": (30.0,),
+	"sharpen": (3.0,),
+	"zoom": (150.0,),
+	"highlight": ("red",),
+	"highlight_beta": ("blue",),
+	"highlights": ("red,#00FF80,blue", 24.0),
+	"tint": ("purple",),
+	"hueshift": (64,),
+	"crunch": (37.0,),
+	"gblur": (6.0,),
+	"boxblur": (4,),
+	"unsharp": (2.0, 1.5),
+}
+default_args = {float: 2.0, int: 2, str: "red"}
+
+sample_chains: List[Tuple[str, ...]] = [
+	("rotate", "45", "jpeg", "invert", "rotate", "-45"),
+	("blur", "blur", "blur", "jpeg"),
+	("grey", "hueshift", "40", "crunch", "20"),
+	("highlight_beta", "red", "saturate", "zoom", "120"),
+	("highlights", "yellow,purple", "0", "jpeg"),
+	("zoom", "0.5", "invert"), # zooming out exposes transparent area
+]
+
+tolerances: Dict[str, float] = {
+	# jpeg output depends on the libjpeg build more than anything else
+	"jpeg": 6.0,
+	"crunch": 6.0,
+}
+
+def sample_image(mode: str = "RGBA", size: Tuple[int, int] = (256, 192)) -> PIL.Image.Image:
+	"""A deterministic test image with hue gradients, hard edges, noise and partial transparency.
+	@param mode "L+tRNS" is a greyscale PNG with a transparent colour key, decoded the way downloads are."""
+	width, height = size
+	y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+	rng = np.random.default_rng(1234)
+	hsv = np.empty((height, width, 3), dtype=np.uint8)
+	hsv[:,:,0] = (x / width * 255).astype(np.uint8)
+	hsv[:,:,1] = np.clip(255 - y / height * 160, 0, 255).astype(np.uint8)
+	hsv[:,:,2] = np.clip(200 + rng.normal(0, 20, (height, width)), 0, 255).astype(np.uint8)
+	hsv[(x // 32 + y // 32) % 2 == 0, 2] //= 2 # checkerboard edges
+	image = PIL.Image.fromarray(hsv, mode="HSV").convert("RGBA")
+	alpha = np.full((height, width), 255, dtype=np.uint8)
+	alpha[(x - width * 0.75) ** 2 + (y - height * 0.25) ** 2 < (height / 6) ** 2] = 96
+	image.putalpha(PIL.Image.fromarray(alpha))
+	if mode == "P":
+		return image.convert("RGB").quantize(32)
+	if mode == "L+tRNS":
+		grey = np.minimum(np.asarray(image.convert("L")), 254)
+		grey[alpha < 255] = 255 # the translucent circle becomes the transparent colour
+		png = io.BytesIO()
+		PIL.Image.fromarray(grey).save(png, format="PNG", transparency=255)
+		return make_image_from_bytes(png.getvalue())
+	return image.convert(mode)
+
+def fingerprint(image: PIL.Image.Image) -> Dict[str, str]:
+	"Block means and block detail (mean absolute gradient) of each of r, g, b and a on a FINGERPRINT_SIZE grid, base64-encoded"
+	arr = np.asarray(image.convert("RGBA"), dtype=np.float32)
+	detail = np.zeros_like(arr)
+	detail[:,1:] += np.abs(np.diff(arr, axis=1))
+	detail[1:,:] += np.abs(np.diff(arr, axis=0))
+	def blocks(channels: np.ndarray) -> str:
+		means = [np.asarray(PIL.Image.fromarray(channels[:,:,c], mode="F").resize(FINGERPRINT_SIZE, PIL.Image.BOX)) for c in range(4)]
+		return base64.b64encode(np.clip(np.rint(np.stack(means, axis=2)), 0, 255).astype(np.uint8).tobytes()).decode()
+	return {"mean": blocks(arr), "detail": blocks(detail)}
+
+def fingerprint_distance(a: Dict[str, str], b: Dict[str, str]) -> float:
+	"The larger of the mean absolute differences of the two fingerprints' maps"
+	def decode(encoded: str) -> np.ndarray:
+		return np.frombuffer(base64.b64decode(encoded), dtype=np.uint8).astype(np.float32)
+	return max(float(np.abs(decode(a[key]) - decode(b[key])).mean()) for key in ("mean", "detail"))
+
+def manipulator_cases() -> Dict[str, Callable[[PIL.Image.Image], PIL.Image.Image]]:
+	cases = {}
+	seen = set()
+	for name, (func, argtypes) in sorted(image_manipulators.items()):
+		if func.__name__ in seen: # aliases
+			continue
+		seen.add(func.__name__)
+		args = sample_args.get(func.__name__, tuple(default_args[typ] for typ in argtypes))
+		cases[func.__name__] = lambda image, func=func, args=args: limit_size(func(image, *args))
+	for chain in sample_chains:
+		steps = []
+		i = 0
+		while i < len(chain):
+			func, argtypes = image_manipulators[chain[i]]
+			steps.append((func, [typ(arg) for typ, arg in zip(argtypes, chain[i + 1:])]))
+			i += 1 + len(argtypes)
+		def run(image, steps=merge_blurs(steps)):
+			for func, args in steps:
+				image = limit_size(func(image, *args))
+			return image
+		cases["chain: " + " ".join(chain)] = run
+	return cases
+
+def time_case(case: Callable[[PIL.Image.Image], PIL.Image.Image], image: PIL.Image.Image, *, repeat: int) -> float:
+	"Best-of-@param repeat wall time in seconds"
+	best = math.inf
+	for _ in range(repeat):
+		start = time.perf_counter()
+		case(image).load()
+		best = min(best, time.perf_counter() - start)
+	return best
+
+def run(*, modes: List[str], repeat: int, update: bool, only: Optional[str] = None) -> int:
+	golden = {}
+	if os.path.exists(GOLDEN_FILE):
+		with open(GOLDEN_FILE) as f:
+			golden = json.load(f)
+	results = {}
+	failures = 0
+	for mode in modes:
+		image = sample_image(mode)
+		for name, case in manipulator_cases().items():
+			if only is not None and only not in name:
+				continue
+			key = "{} [{}]".format(name, mode)
+			output = case(image)
+			result = {"fingerprint": fingerprint(output), "size": list(output.size), "seconds": time_case(case, image, repeat=repeat)}
+			results[key] = result
+			expected = golden.get(key)
+			if expected is None:
+				status, timing = "NEW", ""
+			else:
+				distance = fingerprint_distance(result["fingerprint"], expected["fingerprint"])
+				tolerance = expected.get("tolerance", DEFAULT_TOLERANCE)
+				ok = distance <= tolerance and result["size"] == expected["size"]
+				failures += not ok
+				status = "ok ({:4.2f}/{})".format(distance, tolerance) if ok else "CHANGED ({:.2f}/{}, size {} vs {})".format(distance, tolerance, result["size"], expected["size"])
+				timing = "x{:.2f}".format(result["seconds"] / expected["seconds"]) if expected.get("seconds") else ""
+			print("{:<55} {:>9.2f}ms {:>7} {}".format(key, result["seconds"] * 1000, timing, status))
+	if update:
+		for key, result in results.items():
+			result["tolerance"] = tolerances.get(key.split(" [")[0], DEFAULT_TOLERANCE)
+		golden.update(results)
+		with open(GOLDEN_FILE, "w") as f:
+			json.dump(golden, f, indent="\t", sort_keys=True)
+			f.write("\n")
+		print("wrote {} cases to {}".format(len(results), GOLDEN_FILE))
+		return 0
+	print("{} of {} cases changed".format(failures, len(results)))
+	return 1 if failures else 0
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Check manipulator outputs against golden fingerprints and time them")
+	parser.add_argument("--update", action="store_true", help="store the current outputs and timings as the new golden values")
+	parser.add_argument("--modes", nargs="+", default=["RGBA", "RGB", "L", "P", "L+tRNS"], help="input image modes to run every case on")
+	parser.add_argument("--repeat", type=int, default=3, help="timing runs per case (the best is kept)")
+	parser.add_argument("--only", help="only run cases whose name contains this")
+	args = parser.parse_args()
+	sys.exit(run(modes=args.modes, repeat=args.repeat, update=args.update, only=args.only))
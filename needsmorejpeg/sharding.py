@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Discord routes every event for a guild to shard (guild_id >> 22) % shard_count, so when the shards are
+# split over several processes each process only ever sees its own guilds, and per-guild state (voice
+# sessions, queues, caches) can stay process-local. CPU-bound pools are sized with worker_share() so the
+# processes on one machine split the cores between them.
+from typing import List, Dict, Optional, Sequence
+import argparse
+import multiprocessing
+import os
+import random
+import time
+
+process_index: int = 0
+process_count: int = 1
+
+def shard_for_guild(guild_id: int, shard_count: int) -> int:
+	"The shard Discord routes @param guild_id's events to"
+	return (guild_id >> 22) % shard_count
+
+def shard_ranges(shard_count: int, processes: int) -> List[List[int]]:
+	"Split shards 0..@param shard_count-1 into @param processes contiguous, evenly sized ranges"
+	if not 1 <= processes <= shard_count:
+		raise ValueError("need between 1 and {} processes for {} shards, got {}".format(shard_count, shard_count, processes))
+	base, extra = divmod(shard_count, processes)
+	ranges = []
+	start = 0
+	for i in range(processes):
+		size = base + (i < extra)
+		ranges.append(list(range(start, start + size)))
+		start += size
+	return ranges
+
+def worker_share(total: Optional[int] = None) -> int:
+	"How many CPU-bound workers this process should run, so all processes together use about @param total (default: all cores)"
+	if total is None:
+		total = os.cpu_count() or 1
+	return max(1, total // process_count + (process_index < total % process_count))
+
+def _run_process(token: str, shard_ids: Optional[Sequence[int]], shard_count: Optional[int], index: int, count: int) -> None:
+	global process_index, process_count
+	process_index, process_count = index, count
+	from .bot import bot
+	from . import commands
+	bot.shard_ids = list(shard_ids) if shard_ids is not None else None
+	bot.shard_count = shard_count
+	bot.run(token)
+
+def run(token: str, *, shard_count: Optional[int] = None, processes: int = 1) -> None:
+	"Run the bot with @param shard_count shards (None: Discord's recommendation) spread over @param processes processes"
+	if processes == 1:
+		_run_process(token, None, shard_count, 0, 1)
+		return
+	if shard_count is None:
+		raise ValueError("--shards must be given when running more than one process")
+	context = multiprocessing.get_context("spawn") # don't inherit another process's event loop
+	children = [
+		context.Process(target=_run_process, args=(token, shard_ids, shard_count, i, processes), name="shards-{}-{}".format(shard_ids[0], shard_ids[-1]))
+		for i, shard_ids in enumerate(shard_ranges(shard_count, processes))
+	]
+	for child in children:
+		child.start()
+	try:
+		for child in children:
+			child.join()
+	except KeyboardInterrupt:
+		for child in children:
+			child.terminate()
+
+def make_guild_ids(guilds: int, *, seed: int = 0) -> List[int]:
+	"Plausible guild snowflakes: creation timestamps spread over a few years, random worker/sequence bits"
+	rng = random.Random(seed)
+	return [(rng.randrange(0, 3 << 40) << 22) | rng.randrange(0, 1 << 22) for _ in range(guilds)]
+
+def _simulate_process(shard_ids: Sequence[int], shard_count: int, events: Sequence[int], work: int) -> Dict[str, object]:
+	owned = set(shard_ids)
+	per_shard: Dict[int, int] = {shard_id: 0 for shard_id in shard_ids}
+	start = time.perf_counter()
+	for guild_id in events:
+		shard_id = shard_for_guild(guild_id, shard_count)
+		if shard_id not in owned:
+			continue
+		per_shard[shard_id] += 1
+		x = guild_id
+		for _ in range(work): # stand-in for parsing and dispatching the event
+			x = (x * 1103515245 + 12345) & 0xFFFFFFFF
+	return {"per_shard": per_shard, "seconds": time.perf_counter() - start}
+
+def simulate(guilds: int, shard_count: int, processes: int, *, events_per_guild: int = 20, work: int = 200, seed: int = 0) -> Dict[str, object]:
+	"Dispatch a synthetic event stream for @param guilds guilds through the given shard layout and measure throughput"
+	rng = random.Random(seed)
+	guild_ids = make_guild_ids(guilds, seed=seed)
+	# guild activity is heavily skewed; a few big guilds produce most of the events
+	weights = [rng.paretovariate(1.2) for _ in guild_ids]
+	events = rng.choices(guild_ids, weights=weights, k=guilds * events_per_guild)
+	ranges = shard_ranges(shard_count, processes)
+	start = time.perf_counter()
+	with multiprocessing.get_context("spawn").Pool(processes) as pool:
+		results = pool.starmap(_simulate_process, [(shard_ids, shard_count, events, work) for shard_ids in ranges])
+	wall = time.perf_counter() - start
+	per_shard: Dict[int, int] = {}
+	for result in results:
+		per_shard.update(result["per_shard"])
+	per_process = [sum(result["per_shard"].values()) for result in results]
+	return {
+		"events": len(events),
+		"wall_seconds": wall,
+		"events_per_second": len(events) / wall,
+		"per_process_events": per_process,
+		"per_process_seconds": [result["seconds"] for result in results],
+		"imbalance": max(per_process) / (sum(per_process) / len(per_process)),
+		"busiest_shard": max(per_shard, key=per_shard.get),
+	}
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Simulate gateway event dispatch across shards and processes")
+	parser.add_argument("--guilds", type=int, default=10000)
+	parser.add_argument("--shards", type=int, default=8)
+	parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+	parser.add_argument("--events-per-guild", type=int, default=20)
+	parser.add_argument("--work", type=int, default=200, help="busy-loop iterations per event")
+	args = parser.parse_args()
+	for processes in args.processes:
+		result = simulate(args.guilds, args.shards, processes, events_per_guild=args.events_per_guild, work=args.work)
+		print("{} shards / {} processes: {} events in {:.2f}s ({:.0f}/s), imbalance {:.2f}, per process {}".format(
+			args.shards, processes, result["events"], result["wall_seconds"], result["events_per_second"],
+			result["imbalance"], result["per_process_events"]))
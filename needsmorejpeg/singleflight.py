@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+from typing import Dict, Hashable, Callable, Awaitable, Any
+import asyncio
+
+class SingleFlight:
+	"""Coalesces concurrent calls with the same key into one in-flight computation whose result every caller shares.
+	The computation is cancelled once every caller waiting on it has been cancelled.
+	Nothing is kept once the computation finishes; this is not a cache."""
+	def __init__(self, name: str):
+		self.name = name
+		self._inflight: Dict[Hashable, asyncio.Future] = {}
+		self._waiters: Dict[asyncio.Future, int] = {}
+		self.started = 0 # computations actually run
+		self.coalesced = 0 # calls that joined an in-flight computation instead
+
+	async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+		future = self._inflight.get(key)
+		if future is not None:
+			self.coalesced += 1
+		else:
+			future = asyncio.ensure_future(func())
+			self._inflight[key] = future
+			self.started += 1
+			future.add_done_callback(lambda f: self._done(key, f))
+		self._waiters[future] = self._waiters.get(future, 0) + 1
+		try:
+			# one waiter being cancelled (e.g. its command erroring) must not cancel the others
+			return await asyncio.shield(future)
+		except asyncio.CancelledError:
+			if self._waiters.get(future) == 1 and not future.done(): # the last one out cancels the work
+				# and forgets it now, since it can take a while to unwind; new callers start afresh
+				if self._inflight.get(key) is future:
+					del self._inflight[key]
+				future.cancel()
+			raise
+		finally:
+			self._waiters[future] -= 1
+			if not self._waiters[future]:
+				del self._waiters[future]
+
+	def _done(self, key: Hashable, future: asyncio.Future) -> None:
+		if self._inflight.get(key) is future:
+			del self._inflight[key]
+		if not future.cancelled():
+			future.exception() # mark as retrieved even if every waiter went away
+
+	def in_flight(self) -> int:
+		return len(self._inflight)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+from typing import Optional, Dict
+import collections
+import asyncio
+import time
+import discord
+
+from .bot import bot, ErrorWithMessage
+from .audio_queue import get_queue
+
+class VoiceSession:
+	"One voice connection for a guild, kept warm between commands."
+	def __init__(self, voice_client: discord.VoiceClient):
+		self.voice_client = voice_client
+		self.connected_at = time.monotonic()
+		self.last_active = self.connected_at
+
+	def touch(self) -> None:
+		self.last_active = time.monotonic()
+
+	def idle_for(self) -> float:
+		if self.voice_client.is_playing():
+			self.touch()
+		return time.monotonic() - self.last_active
+
+class VoiceSessionManager:
+	"""Keeps at most one voice connection per guild, reusing it across say/play/yt,
+	moving it between channels instead of reconnecting, and disconnecting it once it has been idle for @param idle_timeout seconds."""
+	def __init__(self, *, idle_timeout: float = 300, check_interval: float = 30):
+		self.idle_timeout = idle_timeout
+		self.check_interval = check_interval
+		self.sessions: Dict[int, VoiceSession] = {}
+		self.counters: Dict[str, int] = {
+			"connects": 0,
+			"reuses": 0,
+			"moves": 0,
+			"busy_refusals": 0,
+			"idle_disconnects": 0,
+			"peak_sessions": 0,
+		}
+		self._reaper: Optional[asyncio.Task] = None
+		# guild id -> lock, so two commands arriving together don't both connect
+		self._locks: Dict[int, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+
+	def _get(self, guild: discord.Guild) -> Optional[VoiceSession]:
+		session = self.sessions.get(guild.id)
+		if session is not None and not session.voice_client.is_connected():
+			# disconnected behind our back (kicked, channel deleted, ...)
+			del self.sessions[guild.id]
+			session = None
+		if session is None and guild.voice_client is not None and guild.voice_client.is_connected():
+			# connected without going through the manager; adopt it
+			session = self.sessions[guild.id] = VoiceSession(guild.voice_client)
+		return session
+
+	async def connect(self, channel: discord.VoiceChannel) -> discord.VoiceClient:
+		"""Get a connected voice client in @param channel, reusing or moving this guild's connection if there is one.
+		A connection that is playing (or has a queue) stays where its listeners are, and the request is refused."""
+		async with self._locks[channel.guild.id]:
+			session = self._get(channel.guild)
+			if session is None:
+				session = self.sessions[channel.guild.id] = VoiceSession(await channel.connect())
+				self.counters["connects"] += 1
+				self.counters["peak_sessions"] = max(self.counters["peak_sessions"], len(self.sessions))
+				self._start_reaper()
+			elif session.voice_client.channel != channel:
+				queue = get_queue(channel.guild)
+				if session.voice_client.is_playing() or queue.current is not None or queue.entries:
+					self.counters["busy_refusals"] += 1
+					raise ErrorWithMessage("I'm already playing in {}; join that channel to add to the queue".format(session.voice_client.channel.name))
+				await session.voice_client.move_to(channel)
+				self.counters["moves"] += 1
+			else:
+				self.counters["reuses"] += 1
+			session.touch()
+			return session.voice_client
+
+	async def disconnect(self, guild: discord.Guild) -> bool:
+		"Disconnect from voice in @param guild. Returns False if there was no connection."
+		async with self._locks[guild.id]:
+			session = self._get(guild)
+			if session is None:
+				return False
+			del self.sessions[guild.id]
+			get_queue(guild).clear()
+			await session.voice_client.disconnect()
+			return True
+
+	def _start_reaper(self) -> None:
+		if self._reaper is None or self._reaper.done():
+			self._reaper = asyncio.ensure_future(self._reap())
+
+	async def _reap(self) -> None:
+		while self.sessions:
+			await asyncio.sleep(self.check_interval)
+			for guild_id, session in list(self.sessions.items()):
+				if not session.voice_client.is_connected():
+					self.sessions.pop(guild_id, None)
+				elif session.idle_for() > self.idle_timeout:
+					self.counters["idle_disconnects"] += 1
+					try:
+						await self.disconnect(session.voice_client.guild)
+					except Exception as ex: # one guild failing mustn't stop idle disconnects for the rest
+						print(ex, "while disconnecting idle voice session in guild", guild_id)
+
+	def stats(self) -> Dict[str, int]:
+		return {"sessions": len(self.sessions), **self.counters}
+
+voice_sessions = VoiceSessionManager()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Image jobs run in separate worker processes so a job that blows its budget, or whose requester
+# deleted their message, can be killed outright instead of running to completion. Each worker is
+# its own process, so killing one doesn't disturb jobs running on the others.
+from typing import Optional, List, Callable, Any
+import asyncio
+import concurrent.futures
+import multiprocessing
+import time
+
+from . import metrics
+from . import sharding
+from .governor import governor, process_rss
+
+# Long-lived workers accumulate fragmented PIL/numpy heap, so they are replaced after this much use
+RECYCLE_AFTER_JOBS = 200
+RECYCLE_AFTER_RSS = 768 * 2**20
+
+class JobTimeout(Exception):
+	pass
+
+def _worker_main(connection) -> None:
+	from . import commands # register the manipulators in this process
+	while True:
+		try:
+			func, args = connection.recv()
+		except EOFError:
+			return
+		try:
+			connection.send((True, func(*args)))
+		except Exception as ex:
+			connection.send((False, ex))
+
+class Worker:
+	def __init__(self, context):
+		self.connection, child_connection = context.Pipe()
+		self.process = context.Process(target=_worker_main, args=(child_connection,), daemon=True, name="needsmorejpeg-worker")
+		self.process.start()
+		child_connection.close()
+		self.jobs = 0
+		self.started = time.monotonic()
+
+	async def call(self, executor: concurrent.futures.Executor, func: Callable, *args) -> Any:
+		"Run @param func(*@param args) in this worker, waiting for the result on a thread of @param executor"
+		self.jobs += 1
+		self.connection.send((func, args))
+		ok, value = await asyncio.get_event_loop().run_in_executor(executor, self.connection.recv)
+		if not ok:
+			raise value
+		return value
+
+	def worn_out(self) -> bool:
+		return self.jobs >= RECYCLE_AFTER_JOBS or (process_rss(self.process.pid) or 0) > RECYCLE_AFTER_RSS
+
+	def kill(self) -> None:
+		self.process.kill()
+		self.process.join()
+		self.connection.close()
+
+class WorkerPool:
+	"Up to @param size worker processes, started as needed; a worker is killed and replaced if its job is cancelled or times out"
+	def __init__(self, size: Optional[int] = None):
+		self.size = size
+		self.context = multiprocessing.get_context("spawn")
+		self.idle: List[Worker] = []
+		self.busy = 0
+		self._available: Optional[asyncio.Condition] = None
+		# one thread per running job blocks waiting for its result; kept apart from the default
+		# executor so running jobs can't starve fetches, decodes and worker startup
+		self._receivers: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+	def full_capacity(self) -> int:
+		return self.size if self.size is not None else sharding.worker_share()
+
+	def capacity(self) -> int:
+		return max(1, int(self.full_capacity() * governor.concurrency_factor))
+
+	def receivers(self) -> concurrent.futures.ThreadPoolExecutor:
+		if self._receivers is None:
+			self._receivers = concurrent.futures.ThreadPoolExecutor(max(1, self.full_capacity()), thread_name_prefix="needsmorejpeg-worker-recv")
+		return self._receivers
+
+	def recycle_idle(self) -> None:
+		"Kill idle workers; new ones start (with a fresh heap) when needed"
+		while self.idle:
+			metrics.count("workers_recycled")
+			self.idle.pop().kill()
+
+	async def _acquire(self) -> Worker:
+		governor.start()
+		if self._available is None:
+			self._available = asyncio.Condition()
+		async with self._available:
+			while self.busy >= self.capacity(): # even with idle workers, so lowering capacity takes effect
+				await self._available.wait()
+			self.busy += 1
+		if self.idle:
+			return self.idle.pop()
+		try:
+			return await asyncio.get_event_loop().run_in_executor(None, Worker, self.context)
+		except BaseException:
+			self.busy -= 1
+			raise
+
+	async def _release(self, worker: Optional[Worker]) -> None:
+		if worker is not None and worker.worn_out():
+			metrics.count("workers_recycled")
+			worker.kill()
+		elif worker is not None:
+			self.idle.append(worker)
+		async with self._available:
+			self.busy -= 1
+			self._available.notify()
+
+	async def run(self, func: Callable, *args, timeout: float) -> Any:
+		"Run @param func(*@param args) in a worker process, killing the worker if it takes longer than @param timeout seconds"
+		worker = await self._acquire()
+		try:
+			return await asyncio.wait_for(worker.call(self.receivers(), func, *args), timeout)
+		except asyncio.TimeoutError:
+			metrics.count("workers_killed_timeout")
+			worker.kill()
+			worker = None
+			raise JobTimeout
+		except asyncio.CancelledError:
+			metrics.count("workers_killed_cancelled")
+			worker.kill()
+			worker = None
+			raise
+		except (EOFError, OSError): # the worker died (e.g. killed by the OS for using too much memory)
+			metrics.count("workers_died")
+			worker.kill()
+			worker = None
+			raise
+		finally:
+			await asyncio.shield(self._release(worker))
+
+	def describe(self) -> str:
+		idle_rss = sum(process_rss(worker.process.pid) or 0 for worker in self.idle)
+		return "{} busy, {} idle ({:.0f} MiB), capacity {}".format(self.busy, len(self.idle), idle_rss / 2**20, self.capacity())
+
+pool = WorkerPool()
+metrics.gauges["workers"] = pool.describe
+governor.register("idle workers", pool.recycle_idle)